@@ -2,7 +2,8 @@ import atexit
 
 import cx_Oracle
 
-from .env import DATABASE_INFO_EDA
+from .db_fdc import output_type_handler, tune_cursor
+from .env import DATABASE_INFO_EDA, DB_STMTCACHESIZE, DB_NATIVE_FLOAT
 
 
 _arg_key_pairs = [
@@ -37,11 +38,14 @@ def commit():
         _conn.commit()
 
 
-def get_cursor():
+def get_cursor(arraysize=None, prefetchrows=None):
     global _conn
     if _conn is None:
         arg = _build_connct_arg()
         dns_tns = cx_Oracle.makedsn(arg['host'], arg['port'], arg['dbname'])
         _conn = cx_Oracle.connect(arg['user'], arg['password'], dns_tns, threaded=True)
+        _conn.stmtcachesize = DB_STMTCACHESIZE
+        if DB_NATIVE_FLOAT:
+            _conn.outputtypehandler = output_type_handler
         atexit.register(cleanup)
-    return _conn.cursor()
+    return tune_cursor(_conn.cursor(), arraysize, prefetchrows)
@@ -1,8 +1,11 @@
 import atexit
+import threading
 
 import cx_Oracle
 
-from .env import DATABASE_INFO_FDC
+from .env import (
+    DATABASE_INFO_FDC, DB_POOL_MINCONN, DB_POOL_MAXCONN, DB_STMTCACHESIZE,
+    DB_FETCH_ARRAYSIZE, DB_PREFETCHROWS, DB_NATIVE_FLOAT)
 
 
 _arg_key_pairs = [
@@ -22,26 +25,109 @@ def _build_connct_arg():
     }
 
 
-_conn = None
+def output_type_handler(cursor, name, default_type, size, precision, scale):
+    """NUMBER(p, s) with decimals (s > 0) as native float. NUMBER(p, 0)
+    and unconstrained NUMBER stay as cx_Oracle returns them, ints are
+    not turned into floats.
+    """
+    if default_type == cx_Oracle.NUMBER and scale > 0:
+        return cursor.var(cx_Oracle.NATIVE_FLOAT, arraysize=cursor.arraysize)
+
+
+def tune_cursor(cursor, arraysize=None, prefetchrows=None):
+    """apply the fetch settings of dbs.env, or per query ones
+    """
+    cursor.arraysize = arraysize or DB_FETCH_ARRAYSIZE
+    prefetchrows = prefetchrows or DB_PREFETCHROWS
+    if prefetchrows and hasattr(cursor, 'prefetchrows'):
+        cursor.prefetchrows = prefetchrows
+    return cursor
+
+
+# Sessions come from a pool and stay bound to the thread that acquired
+# them until release(), so concurrent workers get their own session.
+_pool = None
+_local = threading.local()
+_lock = threading.Lock()
+
+_CHECKOUT_RETRY = 3
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            arg = _build_connct_arg()
+            dns_tns = cx_Oracle.makedsn(
+                arg['host'], arg['port'], arg['dbname'])
+            _pool = cx_Oracle.SessionPool(
+                arg['user'], arg['password'], dns_tns,
+                min=DB_POOL_MINCONN, max=DB_POOL_MAXCONN, increment=1,
+                threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+        return _pool
+
+
+def _is_alive(conn):
+    try:
+        conn.ping()
+    except cx_Oracle.Error:
+        return False
+    return True
+
+
+def _checkout():
+    """acquire a live session from the pool, reconnect dead ones
+    """
+    pool = _get_pool()
+    for _ in range(_CHECKOUT_RETRY):
+        conn = pool.acquire()
+        if _is_alive(conn):
+            return _setup(conn)
+        pool.drop(conn)
+    return _setup(pool.acquire())
+
+
+def _setup(conn):
+    conn.stmtcachesize = DB_STMTCACHESIZE
+    if DB_NATIVE_FLOAT:
+        conn.outputtypehandler = output_type_handler
+    return conn
+
+
+def _get_conn():
+    return getattr(_local, 'conn', None)
 
 
 def cleanup():
-    global _conn
-    if _conn is not None:
-        _conn.close()
-        _conn = None
+    global _pool
+    with _lock:
+        _pool = None
+
+
+def release():
+    """return the session of the current thread to the pool
+    """
+    conn = _get_conn()
+    if conn is not None:
+        _local.conn = None
+        if _pool is not None:
+            try:
+                _pool.release(conn)
+            except cx_Oracle.Error:
+                _pool.drop(conn)
 
 
 def commit():
-    if _conn is not None:
-        _conn.commit()
-
-
-def get_cursor():
-    global _conn
-    if _conn is None:
-        arg = _build_connct_arg()
-        dns_tns = cx_Oracle.makedsn(arg['host'], arg['port'], arg['dbname'])
-        _conn = cx_Oracle.connect(arg['user'], arg['password'], dns_tns, threaded=True)
-        atexit.register(cleanup)
-    return _conn.cursor()
+    conn = _get_conn()
+    if conn is not None:
+        conn.commit()
+
+
+def get_cursor(arraysize=None, prefetchrows=None):
+    conn = _get_conn()
+    if conn is None:
+        conn = _local.conn = _checkout()
+    return tune_cursor(conn.cursor(), arraysize, prefetchrows)
+
+
+atexit.register(cleanup)
@@ -1,8 +1,13 @@
 import atexit
+import hashlib
+import re
+import threading
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 
-from .env import DATABASE_INFO_PG
+from .env import DATABASE_INFO_PG, DB_POOL_MINCONN, DB_POOL_MAXCONN
 
 
 _arg_key_pairs = [
@@ -21,26 +26,183 @@ def _build_connct_arg():
         if DATABASE_INFO_PG[key]
     )
 
-_conn = None
+
+# Connections come from a pool and stay bound to the thread that checked
+# them out until release(), so concurrent workers get their own session.
+_pool = None
+_slots = threading.BoundedSemaphore(DB_POOL_MAXCONN)
+_local = threading.local()
+_lock = threading.Lock()
+
+_CHECKOUT_RETRY = 3
+
+
+_PARAM = re.compile(r'%\((\w+)\)s|%s')
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """connection remembering the statements prepared in its session
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MINCONN, DB_POOL_MAXCONN, _build_connct_arg(),
+                connection_factory=PreparingConnection)
+        return _pool
+
+
+def _is_alive(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def _checkout():
+    """get a live connection from the pool, reconnect dead ones
+    """
+    pool = _get_pool()
+    _slots.acquire()
+    try:
+        for _ in range(_CHECKOUT_RETRY):
+            conn = pool.getconn()
+            if _is_alive(conn):
+                return conn
+            pool.putconn(conn, close=True)
+        return pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+
+
+def _get_conn():
+    return getattr(_local, 'conn', None)
 
 
 def cleanup():
-    global _conn
-    if _conn is not None:
-        _conn.close()
-        _conn = None
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def release():
+    """return the connection of the current thread to the pool
+    """
+    conn = _get_conn()
+    if conn is not None:
+        _local.conn = None
+        if _pool is not None:
+            _pool.putconn(conn, close=bool(conn.closed))
+        _slots.release()
+
+
+def current():
+    """connection of the current thread, None if it has none
+    """
+    return _get_conn()
+
+
+def attach(conn):
+    """use conn, checked out by a thread waiting on the current one, as
+    the connection of the current thread, so both write in one transaction.
+    None leaves the current thread to check out its own.
+    """
+    _local.conn = conn
+
+
+def detach(conn):
+    """undo attach(conn), a connection the current thread checked out
+    itself goes back to the pool
+    """
+    if _get_conn() is conn:
+        _local.conn = None
+    else:
+        release()
 
 
 def commit():
-    if _conn is not None:
-        _conn.commit()
+    conn = _get_conn()
+    if conn is not None:
+        conn.commit()
+
+
+def rollback():
+    conn = _get_conn()
+    if conn is not None:
+        conn.rollback()
 
 
 def get_cursor():
-    global _conn
-    if _conn is None:
-        arg = _build_connct_arg()
-        _conn = psycopg2.connect(arg)
-        atexit.register(cleanup)
-    return _conn.cursor()
-    
\ No newline at end of file
+    conn = _get_conn()
+    if conn is not None and conn.closed:
+        # connection lost since checkout, get a new one.
+        release()
+        conn = None
+    if conn is None:
+        conn = _local.conn = _checkout()
+    return conn.cursor()
+
+
+def prepare(sql):
+    """turn a %s or %(name)s query into PREPARE text
+    :rtype: (statement name, PREPARE sql, param names or None for %s)
+    """
+    names = []
+    positions = {}
+
+    def number(match):
+        name = match.group(1)
+        if name is None:
+            names.append(None)
+            return '${}'.format(len(names))
+        if name not in positions:
+            names.append(name)
+            positions[name] = len(names)
+        return '${}'.format(positions[name])
+
+    body = _PARAM.sub(number, sql).replace('%%', '%')
+    name = 'nikon_{}'.format(hashlib.md5(sql.encode('utf-8')).hexdigest())
+    if any(names) and None in names:
+        raise ValueError('mixed %s and %(name)s parameters')
+    return name, 'PREPARE {} AS {}'.format(name, body), (
+        names if any(names) else None)
+
+
+def execute_prepared(cursor, sql, params=()):
+    """execute sql as a prepared statement of the cursor connection,
+    PREPARE runs once per session, later calls only EXECUTE.
+    :types: params: sequence for %s, dict for %(name)s
+    """
+    name, prepare_sql, names = prepare(sql)
+    conn = cursor.connection
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        # not from the pool, nothing to reuse
+        return cursor.execute(sql, params)
+    if name not in prepared:
+        cursor.execute(prepare_sql)
+        prepared.add(name)
+    values = [params[key] for key in names] if names else list(params)
+    if not values:
+        return cursor.execute('EXECUTE {}'.format(name))
+    return cursor.execute(
+        'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(values))),
+        values)
+
+
+atexit.register(cleanup)
@@ -8,7 +8,12 @@ import dotenv
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['ROOT_DIR_PATH', 'DATABASE_INFO', 'DATABASE_INFO_PG']
+__all__ = [
+    'ROOT_DIR_PATH', 'DATABASE_INFO', 'DATABASE_INFO_PG',
+    'DB_POOL_MINCONN', 'DB_POOL_MAXCONN', 'DB_STMTCACHESIZE',
+    'DB_FETCH_ARRAYSIZE', 'DB_PREFETCHROWS', 'DB_NATIVE_FLOAT',
+    'WINDOW_CACHE_DIR', 'WINDOW_CACHE_MAX_BYTES'
+]
 
 
 ROOT_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent
@@ -25,6 +30,36 @@ DATABASE_INFO_FDC = dj_database_url.parse(os.environ['DATABASE_URL_FDC'])
 DATABASE_INFO_PG = dj_database_url.parse(os.environ['DATABASE_URL_PG'])
 
 
+# Connection pool size of db_pg and db_fdc.
+DB_POOL_MINCONN = int(os.environ.get('DB_POOL_MINCONN', 1))
+
+DB_POOL_MAXCONN = int(os.environ.get('DB_POOL_MAXCONN', 10))
+
+
+# Statements cached per Oracle session (cx_Oracle stmtcachesize).
+DB_STMTCACHESIZE = int(os.environ.get('DB_STMTCACHESIZE', 50))
+
+
+# Oracle fetch tuning of db_fdc and db cursors, rows per round trip and
+# rows prefetched with execute (prefetchrows needs cx_Oracle >= 8).
+DB_FETCH_ARRAYSIZE = int(os.environ.get('DB_FETCH_ARRAYSIZE', 5000))
+
+DB_PREFETCHROWS = int(os.environ.get('DB_PREFETCHROWS', 0)) or None
+
+# Fetch Oracle NUMBER(p, s) columns with decimals (s > 0) as native floats,
+# integer and unconstrained NUMBER columns are left alone.
+DB_NATIVE_FLOAT = os.environ.get(
+    'DB_NATIVE_FLOAT', 'TRUE').upper() in ('1', 'TRUE', 'YES')
+
+
+# On-disk cache of fetched windows, see dbs.window_cache.
+WINDOW_CACHE_DIR = os.environ.get(
+    'WINDOW_CACHE_DIR', str(ROOT_DIR_PATH.joinpath('cache')))
+
+WINDOW_CACHE_MAX_BYTES = int(
+    os.environ.get('WINDOW_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+
 # This logs everything to stderr.
 LOGGING = {
     'version': 1,
@@ -1,21 +1,519 @@
+import abc
+import io
+import re
+import numbers
+import threading
+
+import cx_Oracle
+import numpy as np
+import psycopg2
+
 from . import db, db_fdc, db_pg
+from .env import DB_FETCH_ARRAYSIZE
 
 from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+
+
+COPY_BATCH_SIZE = 5000
+
+FETCH_ARRAYSIZE = DB_FETCH_ARRAYSIZE
+
+ENDTIME_COLUMNS = [
+    'TOOLID', 'OPERATIONID', 'PRODUCTID', 'CHAMBERID',
+    'GLASSID', 'ENDTIME', 'TSTAMP', 'RECIPEID'
+]
+
+INDEX_GLASSOUT_COLUMNS = [
+    'toolid', 'operationid', 'productid', 'chamberid',
+    'glassid', 'endtime', 'tstamp', 'recipeid', 'login_time'
+]
+
+
+class Row:
+    """One result row, values looked up by column name or position.
+    Rows of one result set share a single column index.
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._values[key]
+        return self._values[self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self.items()))
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self._index)
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return list(zip(self._index, self._values))
+
+
+class ResultSet:
+    """Compact query result, one column index plus the raw row tuples.
+    Iterating or indexing gives Row objects, so row['TOOLID'] works
+    as with a list of dict.
+    """
+    __slots__ = ('columns', 'index', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self.index = {column: idx for idx, column in enumerate(self.columns)}
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        index = self.index
+        return (Row(index, row) for row in self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ResultSet(self.columns, self.rows[key])
+        return Row(self.index, self.rows[key])
+
+    def __repr__(self):
+        return 'ResultSet(columns={!r}, rows={})'.format(
+            self.columns, len(self.rows))
+
+
+class ColumnarResult:
+    """Column oriented query result, one NumPy array per column.
+    Numeric columns are float64 (None as nan) or int64 without None,
+    ids, strings and timestamps stay object arrays.
+    """
+    __slots__ = ('columns', 'arrays')
+
+    def __init__(self, columns, arrays):
+        self.columns = list(columns)
+        self.arrays = OrderedDict(zip(self.columns, arrays))
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        return cls(columns, [column_array(column) for column in values])
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.arrays[self.columns[0]])
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    def take(self, rows):
+        """subset by a boolean mask or row indices
+        """
+        return ColumnarResult(
+            self.columns, [array[rows] for array in self.arrays.values()])
+
+    def matrix(self, columns):
+        """float array(row, columns)
+        """
+        if not columns:
+            return np.empty((len(self), 0))
+        return np.column_stack([
+            self.arrays[column].astype(float)
+            if self.arrays[column].dtype != object else
+            np.array([np.nan if value is None else value
+                      for value in self.arrays[column]], dtype=float)
+            for column in columns
+        ])
+
+    def to_resultset(self):
+        return ResultSet(self.columns, list(zip(
+            *[array.tolist() for array in self.arrays.values()])))
+
+    def __repr__(self):
+        return 'ColumnarResult(columns={!r}, rows={})'.format(
+            self.columns, len(self))
+
+
+def column_array(values):
+    """NumPy array of one column, see ColumnarResult
+    """
+    present = [value for value in values if value is not None]
+    numeric = present and all(
+        isinstance(value, numbers.Number) and not isinstance(value, bool)
+        for value in present)
+    if not numeric:
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    if len(present) == len(values) and all(
+            isinstance(value, numbers.Integral) for value in present):
+        return np.array(values, dtype=np.int64)
+    return np.array(
+        [np.nan if value is None else float(value) for value in values],
+        dtype=float)
+
+
+def columnarfetchall(cursor):
+    """Return all rows from a cursor as a ColumnarResult
+    """
+    columns = [col[0] for col in cursor.description]
+    return ColumnarResult.from_rows(columns, cursor.fetchall())
+
 
 def dictfetchall(cursor):
-    """Return all rows from a cursor as a dict
+    """Return all rows from a cursor as a ResultSet
+    """
+    columns = [col[0] for col in cursor.description]
+    return ResultSet(columns, cursor.fetchall())
+
+
+def dictfetchmany(cursor, size=FETCH_ARRAYSIZE):
+    """Yield rows from a cursor as ResultSet, size rows at a time
     """
+    cursor.arraysize = size
     columns = [col[0] for col in cursor.description]
-    return [
-        OrderedDict(zip(columns, row))
-        for row in cursor.fetchall()
-    ]
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield ResultSet(columns, rows)
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def copy_value(value):
+    """Format one value in PostgreSQL COPY text format
+    """
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def copy_buffer(rows):
+    """Return rows as a file object readable by COPY FROM STDIN
+    """
+    return io.StringIO(''.join(
+        '\t'.join(copy_value(value) for value in row) + '\n'
+        for row in rows
+    ))
+
+
+def merge_stage_sql(table, columns, keys, window_column, compare=None,
+                    where=''):
+    """DELETE, UPDATE and INSERT statements of FdcPGSQL.merge_stage
+    :rtype: (delete sql, update sql, insert sql)
+    """
+    if compare is None:
+        compare = [c for c in columns if c not in keys]
+    fmt = {
+        'table': table,
+        'window': '"{}"'.format(window_column),
+        'where': where,
+        'match': ' AND '.join(
+            's."{0}" = t."{0}"'.format(c) for c in keys),
+        'columns': ', '.join('"{}"'.format(c) for c in columns),
+        'set': ', '.join(
+            '"{0}" = s."{0}"'.format(c)
+            for c in columns if c not in keys),
+        'target': ', '.join('t."{}"'.format(c) for c in compare),
+        'source': ', '.join('s."{}"'.format(c) for c in compare),
+    }
+    delete_sql = """
+        DELETE FROM {table} t
+        WHERE t.{window} > %(psql_lastendtime)s
+        AND t.{window} <= %(ora_lastendtime)s
+        {where}
+        AND NOT EXISTS (
+            SELECT 1 FROM {table}_stage s WHERE {match}
+        )
+        """.format(**fmt)
+    update_sql = """
+        UPDATE {table} t
+        SET {set}
+        FROM {table}_stage s
+        WHERE {match}
+        AND ({target}) IS DISTINCT FROM ({source})
+        """.format(**fmt)
+    insert_sql = """
+        INSERT INTO {table} ({columns})
+        SELECT {columns}
+        FROM {table}_stage s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table} t WHERE {match}
+        )
+        """.format(**fmt)
+    return delete_sql, update_sql, insert_sql
+
+
+class KeysetReader(metaclass=abc.ABCMeta):
+    """Read a window of a rawdata table in pages ordered by the key
+    (tstamp, glassid). Every page starts after the last key of the previous
+    one, so each page is a short index range scan and an interrupted read
+    resumes from last_key instead of the window start.
+    :types: lower_inclusive: bool, tstamp >= starttime instead of >
+    :types: upper_inclusive: bool, tstamp <= endtime instead of <
+    :types: last_key: (tstamp, glassid) to resume after
+    :types: retries: int, re-run a failed page from last_key on a new
+        connection
+    """
+    key = ('tstamp', 'glassid')
+    errors = ()
+
+    def __init__(self, table, starttime, endtime, page_size=FETCH_ARRAYSIZE,
+                 lower_inclusive=False, upper_inclusive=True, last_key=None,
+                 retries=0):
+        self.table = table
+        self.starttime = starttime
+        self.endtime = endtime
+        self.page_size = page_size
+        self.lower_inclusive = lower_inclusive
+        self.upper_inclusive = upper_inclusive
+        self.last_key = last_key
+        self.retries = retries
+
+    @abc.abstractmethod
+    def get_cursor(self):
+        """cursor of the source session
+        """
+
+    @abc.abstractmethod
+    def release(self):
+        """drop the source session, the next page gets a new one
+        """
+
+    @abc.abstractmethod
+    def page_sql(self, first):
+        """query of the first page, or of a page after last_key
+        """
+
+    def fetch_page(self):
+        first = self.last_key is None
+        params = {
+            'endtime': self.endtime,
+            'page_size': self.page_size,
+        }
+        if first:
+            params['starttime'] = self.starttime
+        else:
+            params['tstamp'], params['glassid'] = self.last_key
+        cursor = self.get_cursor()
+        cursor.arraysize = self.page_size
+        cursor.execute(self.page_sql(first), params)
+        return dictfetchall(cursor)
+
+    def pages(self):
+        """yield ResultSet pages until the window is read
+        """
+        failures = 0
+        while True:
+            try:
+                page = self.fetch_page()
+            except self.errors as e:
+                if failures >= self.retries:
+                    raise
+                failures += 1
+                print('{} page after {} failed, retry {}: {}'.format(
+                    self.table, self.last_key, failures, e))
+                self.release()
+                continue
+            if not len(page):
+                return
+            index = {column.lower(): idx
+                     for idx, column in enumerate(page.columns)}
+            last = page.rows[-1]
+            self.last_key = tuple(last[index[column]] for column in self.key)
+            yield page
+            if len(page) < self.page_size:
+                return
+
+    def __iter__(self):
+        return self.pages()
+
+
+class OracleKeysetReader(KeysetReader):
+    """KeysetReader of fdc.<toolid>_rawdata
+    """
+    errors = (cx_Oracle.DatabaseError,)
+
+    def get_cursor(self):
+        return db_fdc.get_cursor(arraysize=self.page_size)
+
+    def release(self):
+        db_fdc.release()
+
+    def page_sql(self, first):
+        if first:
+            after = 'tstamp {} :starttime'.format(
+                '>=' if self.lower_inclusive else '>')
+        else:
+            after = ('(tstamp > :tstamp '
+                     'OR (tstamp = :tstamp AND glassid > :glassid))')
+        return """
+            SELECT *
+            FROM (
+                SELECT *
+                FROM fdc.{table}
+                WHERE {after}
+                AND tstamp {upper} :endtime
+                ORDER BY tstamp, glassid
+            )
+            WHERE ROWNUM <= :page_size
+            """.format(
+                table=self.table,
+                after=after,
+                upper='<=' if self.upper_inclusive else '<'
+            )
+
+
+class PGKeysetReader(KeysetReader):
+    """KeysetReader of <toolid>_rawdata in PostgreSQL. A failed page is
+    not retried by default, the thread connection may hold other writes.
+    """
+    errors = (psycopg2.OperationalError,)
+
+    def get_cursor(self):
+        return db_pg.get_cursor()
+
+    def release(self):
+        db_pg.release()
+
+    def page_sql(self, first):
+        if first:
+            after = 'tstamp {} %(starttime)s'.format(
+                '>=' if self.lower_inclusive else '>')
+        else:
+            after = '(tstamp, glassid) > (%(tstamp)s, %(glassid)s)'
+        return """
+            SELECT *
+            FROM {table}
+            WHERE {after}
+            AND tstamp {upper} %(endtime)s
+            ORDER BY tstamp, glassid
+            LIMIT %(page_size)s
+            """.format(
+                table=self.table,
+                after=after,
+                upper='<=' if self.upper_inclusive else '<'
+            )
 
 
 class FdcPGSQL:
     """ETL PostgreSQL DB method
+    Write methods commit on their own unless they run inside
+    transaction(), which groups them into one unit of work.
     """
 
+    def __init__(self):
+        self._depth = 0
+        self._commit_every = None
+        self._pending = 0
+        self._savepoints = 0
+
+    @contextmanager
+    def transaction(self, commit_every=None):
+        """Run the enclosed writes in one transaction.
+        Nested calls join the outer transaction. If commit_every is set,
+        bulk loads also commit every commit_every rows, except inside a
+        savepoint().
+        """
+        if self._depth:
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+            return
+
+        self._depth = 1
+        self._commit_every = commit_every
+        self._pending = 0
+        try:
+            yield self
+        except BaseException:
+            db_pg.rollback()
+            raise
+        else:
+            db_pg.commit()
+        finally:
+            self._depth = 0
+            self._commit_every = None
+            self._pending = 0
+            self._savepoints = 0
+
+    @contextmanager
+    def savepoint(self, name='nikon_savepoint'):
+        """Inside transaction(), undo only the enclosed writes if they
+        raise and keep the transaction going. Outside it the enclosed
+        writes commit on their own as usual.
+        """
+        if not self._depth:
+            yield self
+            return
+        cursor = db_pg.get_cursor()
+        cursor.execute('SAVEPOINT {}'.format(name))
+        self._savepoints += 1
+        try:
+            yield self
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT {}'.format(name))
+            raise
+        else:
+            cursor.execute('RELEASE SAVEPOINT {}'.format(name))
+        finally:
+            self._savepoints -= 1
+
+    def _commit(self):
+        """commit unless inside transaction()
+        """
+        if not self._depth:
+            db_pg.commit()
+
+    def _group_commit(self, rows):
+        """commit every commit_every rows inside transaction()
+        """
+        # a commit would end the open savepoint
+        if not (self._depth and self._commit_every) or self._savepoints:
+            return
+        self._pending += rows
+        if self._pending >= self._commit_every:
+            db_pg.commit()
+            self._pending = 0
+
     def get_lastendtime(self, toolid, apname):
         """get apname last insert time
         """
@@ -64,6 +562,7 @@ class FdcPGSQL:
             FROM information_schema.columns t
             WHERE 1=1
             AND table_name = %(toolid_rawdata)s
+            ORDER BY ordinal_position
             """,
             {
                 'toolid_rawdata': '{}_rawdata'.format(toolid)
@@ -72,9 +571,22 @@ class FdcPGSQL:
         rows = cursor.fetchall()
         return rows
 
-    def get_toolid(self, update_starttime, update_endtime, num="01"):
-        """
+    def get_toolid(self, update_starttime, update_endtime, num="01",
+                   rawdata_toolids=None):
+        """rawdata_toolids: list of toolid having a rawdata table, e.g.
+        from schema_cache.toolids(); looked up in pg_class when None.
         """
+        if rawdata_toolids is None:
+            rawdata_filter = """
+            AND s.toolid in (
+                SELECT upper(substr(relname,1,8))
+                FROM "pg_class"
+                WHERE 1=1
+                AND "relname" LIKE 'tlcd__01_rawdata' 
+            )
+            """
+        else:
+            rawdata_filter = 'AND s.toolid = ANY(%(rawdata_toolids)s)'
         cursor = db_pg.get_cursor()
         cursor.execute(
             """
@@ -88,32 +600,69 @@ class FdcPGSQL:
                 FROM "tlcd_nikon_avm_operation_associate_ct"
             )
             AND "productid" LIKE 'TL______'
-            AND s.toolid in (
-                SELECT upper(substr(relname,1,8))
-                FROM "pg_class"
-                WHERE 1=1
-                AND "relname" LIKE 'tlcd__01_rawdata' 
-            )
-            """,
+            {}
+            """.format(rawdata_filter),
             {
                 'tlcd': 'TLCD__{}'.format(num),
                 'update_starttime': update_starttime,
-                'update_endtime': update_endtime
+                'update_endtime': update_endtime,
+                'rawdata_toolids': rawdata_toolids
             }
         )
         rows = cursor.fetchall()
         return rows
 
-    def get_nikonrot(self, toolid, update_starttime, update_endtime):
+    def get_nikonrot(self, toolid, update_starttime, update_endtime,
+                     page_size=None, columnar=False):
         """
+        :types: page_size: int, read in keyset pages of page_size rows
+        :types: columnar: bool, return a ColumnarResult
         """
+        fetchall = columnarfetchall if columnar else dictfetchall
+        if page_size:
+            pages = list(self.keyset_nikonrot(
+                toolid=toolid,
+                update_starttime=update_starttime,
+                update_endtime=update_endtime,
+                page_size=page_size
+            ))
+            columns = pages[0].columns if pages else []
+            rows = [row for page in pages for row in page.rows]
+            if columnar:
+                return ColumnarResult.from_rows(columns, rows)
+            return ResultSet(columns, rows)
         cursor = db_pg.get_cursor()
-        sql = "SELECT * FROM {}_rawdata WHERE tstamp >= to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3') "\
-              "AND tstamp < to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3')".format(toolid, update_starttime, update_endtime)
-        cursor.execute(sql)
-        queryset = dictfetchall(cursor)
+        # only the table varies, the statement is prepared once per tool
+        db_pg.execute_prepared(
+            cursor,
+            """
+            SELECT *
+            FROM {}_rawdata
+            WHERE tstamp >= %(update_starttime)s
+            AND tstamp < %(update_endtime)s
+            """.format(toolid),
+            {
+                'update_starttime': update_starttime,
+                'update_endtime': update_endtime
+            }
+        )
+        queryset = fetchall(cursor)
         return queryset
 
+    def keyset_nikonrot(self, toolid, update_starttime, update_endtime,
+                        page_size=FETCH_ARRAYSIZE, last_key=None):
+        """get_nikonrot window [start, end) as a PGKeysetReader
+        """
+        return PGKeysetReader(
+            table='{}_rawdata'.format(toolid),
+            starttime=update_starttime,
+            endtime=update_endtime,
+            page_size=page_size,
+            lower_inclusive=True,
+            upper_inclusive=False,
+            last_key=last_key
+        )
+
     def delete_tlcd(self, psql_lastendtime, ora_lastendtime, num='01'):
         """default num = 01
         """
@@ -133,16 +682,26 @@ class FdcPGSQL:
                 'ora_lastendtime': ora_lastendtime
             }
         )
-        db_pg.commit()
+        self._commit()
 
     def delete_toolid(self, toolid, psql_lastendtime, ora_lastendtime):
         """
         """
         cursor = db_pg.get_cursor()
-        sql = "DELETE FROM {}_rawdata WHERE tstamp > to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3')"\
-              "AND tstamp <= to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3')".format(toolid, psql_lastendtime, ora_lastendtime)
-        cursor.execute(sql)
-        db_pg.commit()
+        db_pg.execute_prepared(
+            cursor,
+            """
+            DELETE
+            FROM {}_rawdata
+            WHERE tstamp > %(psql_lastendtime)s
+            AND tstamp <= %(ora_lastendtime)s
+            """.format(toolid),
+            {
+                'psql_lastendtime': psql_lastendtime,
+                'ora_lastendtime': ora_lastendtime
+            }
+        )
+        self._commit()
 
     def save_endtime(self, endtime_data):
         """Insert many rows at a times
@@ -155,16 +714,110 @@ class FdcPGSQL:
             """,
             {'endtime_data': endtime_data}
         )
-        db_pg.commit()
+        self._commit()
 
     def save_edcdata(self, toolid, edcdata):
         """
         """
         records = ','.join(['%s'] * len(edcdata))
         cursor = db_pg.get_cursor()
-        sql = 'INSERT INTO {}_rawdata VALUES ({})'.format(toolid, records)
-        cursor.execute(sql, edcdata)
-        db_pg.commit()
+        db_pg.execute_prepared(
+            cursor,
+            'INSERT INTO {}_rawdata VALUES ({})'.format(toolid, records),
+            edcdata
+        )
+        self._commit()
+
+    def copy_endtime(self, endtime_datas, batch_size=COPY_BATCH_SIZE):
+        """Bulk load rows into index_glassout with COPY FROM STDIN
+        """
+        count = self._copy(
+            sql='COPY "index_glassout" FROM STDIN',
+            rows=endtime_datas,
+            batch_size=batch_size
+        )
+        self._commit()
+        return count
+
+    def copy_edcdata(self, toolid, edcdatas, batch_size=COPY_BATCH_SIZE):
+        """Bulk load rows into <toolid>_rawdata with COPY FROM STDIN
+        """
+        count = self._copy(
+            sql='COPY {}_rawdata FROM STDIN'.format(toolid),
+            rows=edcdatas,
+            batch_size=batch_size
+        )
+        self._commit()
+        return count
+
+    def create_stage(self, table):
+        """(re)create an empty unlogged <table>_stage, a new one per
+        window so it always has the current columns of table
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute('DROP TABLE IF EXISTS {}_stage'.format(table))
+        cursor.execute(
+            """
+            CREATE UNLOGGED TABLE {0}_stage
+            (LIKE {0} INCLUDING DEFAULTS)
+            """.format(table)
+        )
+        self._commit()
+
+    def copy_stage(self, table, rows, batch_size=COPY_BATCH_SIZE):
+        """Bulk load rows into <table>_stage with COPY FROM STDIN
+        """
+        count = self._copy(
+            sql='COPY {}_stage FROM STDIN'.format(table),
+            rows=rows,
+            batch_size=batch_size
+        )
+        self._commit()
+        return count
+
+    def merge_stage(self, table, columns, keys, window_column,
+                    psql_lastendtime, ora_lastendtime, compare=None,
+                    where='', params=None):
+        """apply <table>_stage to the (psql_lastendtime, ora_lastendtime]
+        window of table with set based statements keyed on keys:
+        delete rows gone from the stage, update rows whose compare columns
+        changed and insert new rows. Unchanged rows are not touched.
+        :types: where: extra filter on the target window, e.g. toolid
+        :rtype: dict(deleted, updated, inserted row count)
+        """
+        sql_params = {
+            'psql_lastendtime': psql_lastendtime,
+            'ora_lastendtime': ora_lastendtime,
+        }
+        sql_params.update(params or {})
+        delete_sql, update_sql, insert_sql = merge_stage_sql(
+            table=table,
+            columns=columns,
+            keys=keys,
+            window_column=window_column,
+            compare=compare,
+            where=where
+        )
+        cursor = db_pg.get_cursor()
+        cursor.execute(delete_sql, sql_params)
+        deleted = cursor.rowcount
+        cursor.execute(update_sql)
+        updated = cursor.rowcount
+        cursor.execute(insert_sql)
+        inserted = cursor.rowcount
+        self._commit()
+        return {'deleted': deleted, 'updated': updated, 'inserted': inserted}
+
+    def _copy(self, sql, rows, batch_size):
+        """stream rows to COPY, batch_size rows per round trip
+        """
+        cursor = db_pg.get_cursor()
+        count = 0
+        for batch in chunked(rows, batch_size):
+            cursor.copy_expert(sql, copy_buffer(batch))
+            count += len(batch)
+            self._group_commit(len(batch))
+        return count
 
     def update_lastendtime(self, toolid, apname, last_endtime):
         """
@@ -183,7 +836,179 @@ class FdcPGSQL:
                 "toolid": toolid
             }
         )
-        db_pg.commit()
+        self._commit()
+
+    def get_lastendtimes(self, apname, tool_like='TLCD%'):
+        """per-tool watermarks of apname
+        :rtype: OrderedDict(lower toolid: last_end_time)
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            SELECT "toolid", "last_end_time"
+            FROM "lastendtime"
+            WHERE "toolid" LIKE %(tool_like)s
+            AND "enabled" = 'TRUE'
+            AND "apname" = %(apname)s
+            ORDER BY "toolid"
+            """,
+            {
+                'tool_like': tool_like,
+                'apname': apname
+            },
+        )
+        return OrderedDict(
+            (toolid.lower(), last_endtime)
+            for toolid, last_endtime in cursor.fetchall()
+        )
+
+    def update_lastendtimes(self, apname, last_endtimes):
+        """move per-tool watermarks forward, the row of a tool is created
+        on its first update.
+        :types: last_endtimes: dict(toolid: last_endtime)
+        """
+        cursor = db_pg.get_cursor()
+        for toolid, last_endtime in sorted(last_endtimes.items()):
+            params = {
+                "last_endtime": last_endtime,
+                "apname": apname,
+                "toolid": toolid.upper()
+            }
+            cursor.execute(
+                """
+                UPDATE lastendtime
+                SET last_end_time = GREATEST(last_end_time, %(last_endtime)s),
+                update_time = now()
+                WHERE apname = %(apname)s
+                AND toolid = %(toolid)s
+                """,
+                params
+            )
+            if not cursor.rowcount:
+                cursor.execute(
+                    """
+                    INSERT INTO lastendtime
+                    (toolid, apname, last_end_time, enabled, update_time)
+                    VALUES (%(toolid)s, %(apname)s, %(last_endtime)s,
+                    'TRUE', now())
+                    """,
+                    params
+                )
+        self._commit()
+
+    def derive_lastendtime(self, toolid, apname, tool_like='TLCD%'):
+        """set the toolid (NIKON) watermark to the minimum of the per-tool
+        watermarks, unchanged if there is no per-tool row.
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            UPDATE lastendtime n
+            SET last_end_time = t.last_end_time, update_time = now()
+            FROM (
+                SELECT min(last_end_time) AS last_end_time
+                FROM lastendtime
+                WHERE toolid LIKE %(tool_like)s
+                AND enabled = 'TRUE'
+                AND apname = %(apname)s
+            ) t
+            WHERE n.apname = %(apname)s
+            AND n.toolid = %(toolid)s
+            AND t.last_end_time IS NOT NULL
+            """,
+            {
+                "tool_like": tool_like,
+                "apname": apname,
+                "toolid": toolid
+            }
+        )
+        self._commit()
+
+    def get_rotcols(self):
+        """ROT alignment columns of tlcd rawdata
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            SELECT col_name
+            FROM tlcd_avm_col
+            WHERE 1=1
+            AND category = 'tp_al'
+            """
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_prodwithdv(self):
+        """products having design values
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            SELECT DISTINCT product
+            FROM tlcd_nikon_main_v
+            """
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_designvalue(self, prodt, dvtable):
+        """design value coordinates (pos_no, x, y) of a product
+        """
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            SELECT s.pos_no, s.x_coord AS x, s.y_coord AS y
+            FROM {} s, (
+                SELECT cfg_id
+                FROM tlcd_nikon_main_v t
+                WHERE 1=1
+                AND product = %(product)s
+            ) a
+            WHERE 1=1
+            AND s.cfg_id = a.cfg_id
+            """.format(dvtable),
+            {'product': prodt}
+        )
+        queryset = dictfetchall(cursor)
+        return queryset
+
+    def save_rot(self, columns, records):
+        """Insert ROT results, one tlcd_nikon_rot_log_ht row per glass and
+        its rot_rs values into tlcd_nikon_rot_bt.
+        :types: columns: tlcd_nikon_rot_log_ht columns before flag
+        :types: records: list((ht values with flag, [(item_name, rot_rs)]))
+        """
+        cursor = db_pg.get_cursor()
+        sql = """
+            INSERT INTO tlcd_nikon_rot_log_ht ({}, flag)
+            VALUES ({})
+            RETURNING rot_id
+            """.format(
+                ', '.join(columns), ', '.join(['%s'] * (len(columns) + 1)))
+        rot_rows = []
+        for ht, values in records:
+            cursor.execute(sql, ht)
+            rot_id = cursor.fetchone()[0]
+            rot_rows.extend(
+                (item_name, rot_rs, rot_id) for item_name, rot_rs in values)
+        self._copy(
+            sql='COPY tlcd_nikon_rot_bt (item_name, rot_rs, rot_id) '
+                'FROM STDIN',
+            rows=rot_rows,
+            batch_size=COPY_BATCH_SIZE
+        )
+        self._commit()
+
+    def save_rot_error(self, columns, rows):
+        """Insert ROT error rows into tlcd_nikon_rot_log_ht
+        :types: columns: tlcd_nikon_rot_log_ht columns before flag, descr
+        """
+        self._copy(
+            sql='COPY tlcd_nikon_rot_log_ht ({}, flag, descr) '
+                'FROM STDIN'.format(', '.join(columns)),
+            rows=rows,
+            batch_size=COPY_BATCH_SIZE
+        )
+        self._commit()
 
     def refresh_nikonmea(self):
         """
@@ -197,6 +1022,67 @@ class FdcPGSQL:
         )
 
 
+class SchemaCache:
+    """Per-run cache of the tlcd rawdata tables in PostgreSQL.
+    One catalog query loads every table and its columns, lookups are
+    then served from memory until invalidate().
+    """
+
+    def __init__(self):
+        self._tables = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        cursor = db_pg.get_cursor()
+        cursor.execute(
+            """
+            SELECT table_name, column_name
+            FROM information_schema.columns t
+            WHERE 1=1
+            AND table_name LIKE %(rawdata)s
+            ORDER BY table_name, ordinal_position
+            """,
+            {'rawdata': 'tlcd%_rawdata'}
+        )
+        tables = OrderedDict()
+        for table_name, column_name in cursor.fetchall():
+            tables.setdefault(table_name, []).append((column_name,))
+        return tables
+
+    def _get_tables(self):
+        with self._lock:
+            if self._tables is None:
+                self._tables = self.load()
+            return self._tables
+
+    def invalidate(self):
+        with self._lock:
+            self._tables = None
+
+    def exists(self, toolid):
+        """same as get_pgclass count > 0
+        """
+        return '{}_rawdata'.format(toolid) in self._get_tables()
+
+    def schemacolnames(self, toolid):
+        """same rows as FdcPGSQL.get_schemacolnames
+        """
+        return list(self._get_tables().get('{}_rawdata'.format(toolid), []))
+
+    def toolids(self, num='01'):
+        """upper toolids having a tlcd__<num>_rawdata table
+        """
+        pattern = re.compile(r'tlcd..{}_rawdata'.format(num))
+        return [
+            table_name[:8].upper()
+            for table_name in self._get_tables()
+            if pattern.fullmatch(table_name)
+        ]
+
+
+schema_cache = SchemaCache()
+
+
 class FdcOracle:
     """InnoLux  FDC Oracle DB method
     """
@@ -237,17 +1123,105 @@ class FdcOracle:
         queryset = dictfetchall(cursor)
         return queryset
 
-    def get_edcdata(self, toolid, psql_lastendtime, ora_lastendtime):
+    def get_endtimes(self, psql_lastendtime, ora_lastendtime, num='01'):
+        """sorted endtime of every index_glassout row in the window
         """
+        cursor = db_fdc.get_cursor()
+        cursor.execute(
+            """
+            SELECT endtime
+            FROM fdc.index_glassout
+            WHERE toolid LIKE :tlcd
+            AND endtime > :psql_lastendtime
+            AND endtime <= :ora_lastendtime
+            ORDER BY endtime
+            """,
+            {
+                'tlcd': 'TLCD__{}'.format(num),
+                'psql_lastendtime': psql_lastendtime,
+                'ora_lastendtime': ora_lastendtime
+            }
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def iter_endtimedata(self, psql_lastendtime, ora_lastendtime, num='01',
+                         arraysize=FETCH_ARRAYSIZE):
+        """Same as get_endtimedata, yield ResultSet of arraysize rows
+        with ENDTIME_COLUMNS in index_glassout column order
+        """
+        cursor = db_fdc.get_cursor(arraysize=arraysize)
+        cursor.execute(
+            """
+            SELECT {}
+            FROM fdc.index_glassout
+            WHERE toolid LIKE :tlcd
+            AND endtime > :psql_lastendtime
+            AND endtime <= :ora_lastendtime
+            """.format(', '.join(ENDTIME_COLUMNS)),
+            {
+                'tlcd': 'TLCD__{}'.format(num),
+                'psql_lastendtime': psql_lastendtime,
+                'ora_lastendtime': ora_lastendtime
+            }
+        )
+        yield from dictfetchmany(cursor, arraysize)
+
+    def get_edcdata(self, toolid, psql_lastendtime, ora_lastendtime,
+                    columnar=False):
+        """
+        :types: columnar: bool, return a ColumnarResult
         """
         cursor = db_fdc.get_cursor()
-        sql = "SELECT * FROM fdc.{}_rawdata WHERE tstamp > to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3')" \
-              "AND tstamp <= to_timestamp('{}', 'YYYY-MM-DD HH24:MI:SS.FF3')".format(toolid, psql_lastendtime, ora_lastendtime)
-        #sql = "SELECT * FROM fdc.tlcd0801_rawdata WHERE tstamp > to_timestamp('2017-10-26 23:31:27', 'YYYY-MM-DD HH24:MI:SS.FF3') AND tstamp <= to_timestamp('2017-11-09 17:09:01', 'YYYY-MM-DD HH24:MI:SS.FF3')"
-        cursor.execute(sql)
+        # bind variables keep one cursor per tool in the session cache
+        cursor.execute(
+            """
+            SELECT *
+            FROM fdc.{}_rawdata
+            WHERE tstamp > :psql_lastendtime
+            AND tstamp <= :ora_lastendtime
+            """.format(toolid),
+            {
+                'psql_lastendtime': psql_lastendtime,
+                'ora_lastendtime': ora_lastendtime
+            }
+        )
+        if columnar:
+            return columnarfetchall(cursor)
         queryset = dictfetchall(cursor)
         return queryset
 
+    def iter_edcdata(self, toolid, psql_lastendtime, ora_lastendtime,
+                     arraysize=FETCH_ARRAYSIZE):
+        """Same as get_edcdata, yield ResultSet of arraysize rows
+        """
+        cursor = db_fdc.get_cursor(arraysize=arraysize)
+        cursor.execute(
+            """
+            SELECT *
+            FROM fdc.{}_rawdata
+            WHERE tstamp > :psql_lastendtime
+            AND tstamp <= :ora_lastendtime
+            """.format(toolid),
+            {
+                'psql_lastendtime': psql_lastendtime,
+                'ora_lastendtime': ora_lastendtime
+            }
+        )
+        yield from dictfetchmany(cursor, arraysize)
+
+    def keyset_edcdata(self, toolid, psql_lastendtime, ora_lastendtime,
+                       page_size=FETCH_ARRAYSIZE, last_key=None, retries=3):
+        """get_edcdata window (start, end] as an OracleKeysetReader
+        """
+        return OracleKeysetReader(
+            table='{}_rawdata'.format(toolid),
+            starttime=psql_lastendtime,
+            endtime=ora_lastendtime,
+            page_size=page_size,
+            last_key=last_key,
+            retries=retries
+        )
+
 
 class EdaOracle:
     """InnoLux EDC Oracle DB method
@@ -281,3 +1255,70 @@ class EdaOracle:
         )
         queryset = dictfetchall(cursor)
         return queryset
+
+
+class MeasRotCache:
+    """Window keyed cache of EdaOracle.get_measrotdata. The query does not
+    depend on toolid, so every tool of a window shares one fetch. Rows are
+    also partitioned by EQUIP_ID. Windows stay until evict().
+    """
+
+    def __init__(self):
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_window(self, update_starttime, update_endtime):
+        key = (update_starttime, update_endtime)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = {
+                    'lock': threading.Lock(),
+                    'rows': None,
+                    'by_equip': None,
+                }
+        # fetch outside the cache lock, other windows are not blocked.
+        with window['lock']:
+            if window['rows'] is None:
+                rows = EdaOracle().get_measrotdata(
+                    update_starttime=update_starttime,
+                    update_endtime=update_endtime
+                )
+                by_equip = OrderedDict()
+                equip_idx = rows.index['EQUIP_ID']
+                for row in rows.rows:
+                    by_equip.setdefault(row[equip_idx], []).append(row)
+                window['by_equip'] = OrderedDict(
+                    (equip_id, ResultSet(rows.columns, equip_rows))
+                    for equip_id, equip_rows in by_equip.items()
+                )
+                window['rows'] = rows
+        return window
+
+    def get(self, update_starttime, update_endtime):
+        """same rows as EdaOracle.get_measrotdata
+        """
+        return self._get_window(update_starttime, update_endtime)['rows']
+
+    def by_equip(self, update_starttime, update_endtime):
+        """
+        :rtype: OrderedDict(EQUIP_ID: ResultSet)
+        """
+        return self._get_window(update_starttime, update_endtime)['by_equip']
+
+    def equip(self, update_starttime, update_endtime, equip_id):
+        rows = self._get_window(update_starttime, update_endtime)
+        return rows['by_equip'].get(
+            equip_id, ResultSet(rows['rows'].columns, []))
+
+    def evict(self, update_starttime=None, update_endtime=None):
+        """drop one window, or every window when called without one
+        """
+        with self._lock:
+            if update_starttime is None and update_endtime is None:
+                self._windows.clear()
+            else:
+                self._windows.pop((update_starttime, update_endtime), None)
+
+
+measrot_cache = MeasRotCache()
@@ -0,0 +1,239 @@
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+from .env import WINDOW_CACHE_DIR, WINDOW_CACHE_MAX_BYTES
+from .nikon import ResultSet
+
+
+# An entry is one directory holding every batch of the window as a chunk.
+# Columns of a chunk go into blocks by kind, float64, int64 and
+# datetime64[us] blocks are .npy files opened with mmap_mode='r', anything
+# else (ids, strings, Decimal, ...) is pickled as is. A bool mask block
+# keeps which values were None, so rows come back exactly as fetched.
+_META = 'meta.json'
+
+_INT64_MIN = -2 ** 63
+
+_INT64_MAX = 2 ** 63 - 1
+
+_BLOCK_DTYPES = [
+    ('float', np.float64),
+    ('int', np.int64),
+    ('datetime', 'datetime64[us]'),
+]
+
+
+def _key_name(toolid, starttime, endtime):
+    key = '{}|{}|{}'.format(toolid, starttime.isoformat(), endtime.isoformat())
+    return '{}-{}'.format(toolid, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def column_kind(values):
+    """block kind of one column of a batch, 'object' unless every value
+    besides None round trips through the NumPy block unchanged
+    """
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        if type(value) is float:
+            value_kind = 'float'
+        elif type(value) is int and _INT64_MIN <= value <= _INT64_MAX:
+            value_kind = 'int'
+        elif type(value) is datetime.datetime and value.tzinfo is None:
+            value_kind = 'datetime'
+        else:
+            return 'object'
+        if kind is None:
+            kind = value_kind
+        elif kind != value_kind:
+            return 'object'
+    return kind or 'object'
+
+
+def _fill_value(kind):
+    if kind == 'datetime':
+        return np.datetime64('NaT')
+    return 0
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+class WindowCache:
+    """On-disk cache of fetched tool windows keyed by
+    (toolid, starttime, endtime). An entry remembers the source watermark
+    it was fetched under and is dropped when the watermark has moved.
+    Entries beyond max_bytes are evicted least recently used first.
+    """
+
+    def __init__(self, path=WINDOW_CACHE_DIR,
+                 max_bytes=WINDOW_CACHE_MAX_BYTES):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entry(self, toolid, starttime, endtime):
+        return os.path.join(self.path, _key_name(toolid, starttime, endtime))
+
+    def get(self, toolid, starttime, endtime, watermark):
+        """
+        :rtype: iterator of ResultSet, the batches as stored, None on miss
+        """
+        entry = self._entry(toolid, starttime, endtime)
+        with self._lock:
+            try:
+                with open(os.path.join(entry, _META)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if meta['watermark'] != str(watermark):
+                print('Window cache {} watermark moved, drop'.format(toolid))
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            # recently used, see evict()
+            os.utime(os.path.join(entry, _META))
+        print('Window cache hit {} ({}, {}]: {} rows'.format(
+            toolid, starttime, endtime,
+            sum(chunk['rows'] for chunk in meta['chunks'])))
+        return self._read(entry, meta)
+
+    def _read(self, entry, meta):
+        for idx, chunk in enumerate(meta['chunks']):
+            path = os.path.join(entry, str(idx))
+            blocks = {
+                kind: np.load('{}.{}.npy'.format(path, kind), mmap_mode='r')
+                for kind, _ in _BLOCK_DTYPES if chunk['blocks'].get(kind)
+            }
+            if chunk['blocks'].get('object'):
+                with open(path + '.pkl', 'rb') as f:
+                    blocks['object'] = pickle.load(f)
+            mask = np.load(path + '.mask.npy', mmap_mode='r')
+            columns = []
+            for column, (kind, position) in enumerate(chunk['kinds']):
+                if kind == 'object':
+                    columns.append(blocks['object'][position])
+                    continue
+                values = blocks[kind][:, position].tolist()
+                for row in np.flatnonzero(mask[:, column]).tolist():
+                    values[row] = None
+                columns.append(values)
+            yield ResultSet(meta['columns'], list(zip(*columns)))
+
+    def _write_chunk(self, path, batch):
+        """store one batch, columns split into kind blocks
+        :rtype: dict, chunk meta
+        """
+        values = list(zip(*batch.rows))
+        kinds = []
+        blocks = {kind: [] for kind, _ in _BLOCK_DTYPES}
+        blocks['object'] = []
+        for column in values:
+            kind = column_kind(column)
+            kinds.append((kind, len(blocks[kind])))
+            blocks[kind].append(column)
+        mask = np.array(
+            [[value is None for value in column] for column in values],
+            dtype=bool).T.reshape(len(batch.rows), len(values))
+        np.save(path + '.mask.npy', mask)
+        for kind, dtype in _BLOCK_DTYPES:
+            if not blocks[kind]:
+                continue
+            fill = _fill_value(kind)
+            block = np.array([
+                [fill if value is None else value for value in column]
+                for column in blocks[kind]
+            ], dtype=dtype).T
+            np.save('{}.{}.npy'.format(path, kind), block)
+        if blocks['object']:
+            with open(path + '.pkl', 'wb') as f:
+                pickle.dump([list(column) for column in blocks['object']],
+                            f, pickle.HIGHEST_PROTOCOL)
+        return {
+            'rows': len(batch.rows),
+            'kinds': kinds,
+            'blocks': {kind: len(columns) for kind, columns in blocks.items()},
+        }
+
+    def put(self, toolid, starttime, endtime, watermark, batches):
+        """yield batches as they come and store them, the entry is only
+        visible once every batch went through. Nothing is kept when the
+        consumer stops early or the source raises.
+        :types: batches: iterator of ResultSet of one query
+        """
+        entry = self._entry(toolid, starttime, endtime)
+        tmp = '{}.tmp-{}'.format(entry, uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            columns = []
+            chunks = []
+            for batch in batches:
+                if len(batch.rows):
+                    columns = batch.columns
+                    chunks.append(self._write_chunk(
+                        os.path.join(tmp, str(len(chunks))), batch))
+                yield batch
+            # meta last, an entry without it is never read
+            with open(os.path.join(tmp, _META), 'w') as f:
+                json.dump({
+                    'toolid': toolid,
+                    'starttime': str(starttime),
+                    'endtime': str(endtime),
+                    'watermark': str(watermark),
+                    'columns': columns,
+                    'chunks': chunks,
+                }, f)
+            with self._lock:
+                shutil.rmtree(entry, ignore_errors=True)
+                os.rename(tmp, entry)
+                self._evict()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def fetch(self, toolid, starttime, endtime, watermark, batches):
+        """cached batches of the window, or batches stored while they are
+        consumed
+        :rtype: iterator of ResultSet
+        """
+        cached = self.get(toolid, starttime, endtime, watermark)
+        if cached is not None:
+            return cached
+        return self.put(toolid, starttime, endtime, watermark, batches)
+
+    def invalidate(self, toolid=None):
+        """drop every entry, or the entries of one toolid
+        """
+        with self._lock:
+            if not os.path.isdir(self.path):
+                return
+            for name in os.listdir(self.path):
+                if toolid is None or name.startswith('{}-'.format(toolid)):
+                    shutil.rmtree(
+                        os.path.join(self.path, name), ignore_errors=True)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            meta = os.path.join(entry, _META)
+            if os.path.isfile(meta):
+                entries.append(
+                    (os.path.getmtime(meta), _dir_size(entry), entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -5,24 +5,43 @@ import time
 import logging
 import uuid
 import asyncio
+import queue
 
 import lazy_logger
+import nikonrot
 
-from dbs import nikon
+from dbs import db_fdc, db_pg, nikon, window_cache
 
-from contextlib import contextmanager
+from concurrent import futures
 from collections import OrderedDict, namedtuple
 from itertools import dropwhile, chain
+from operator import itemgetter
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+MAX_WORKER = 8
+
+R_MAX_WORKER = 8
+
+ROT_WINDOW_SECONDS = 86400
+
+RPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'R')
+
 ParsedCompletedCommand = namedtuple(
     'ParsedCompletedCommand',
     ['returncode', 'args', 'stdout', 'stderr']
 )
 
 
+class TlcdFlowError(RuntimeError):
+
+    def __init__(self, *, errors, result=None):
+        super().__init__(f'(toolids={sorted(errors)!r})')
+        self.errors = errors
+        self.result = result
+
+
 def log_time():
     """return log datetime
     rtype: str time
@@ -45,16 +64,6 @@ def call_lazylog(f):
     return lazylog
 
 
-@contextmanager
-def cd(newdir):
-    prevdir = os.getcwd()
-    os.chdir(newdir)
-    try:
-        yield
-    finally:
-        os.chdir(prevdir)
-
-
 def decode_cmd_out(completed_cmd):
     try:
         stdout = completed_cmd.stdout.encode('utf-8').decode()
@@ -72,14 +81,20 @@ def decode_cmd_out(completed_cmd):
     )
 
 
+def decode_line(line):
+    try:
+        return line.decode('utf-8').rstrip('\r\n')
+    except UnicodeDecodeError:
+        return line.decode('big5', 'replace').rstrip('\r\n')
+
+
 def run_command_under_r_root(cmd, catched=True):
-    RPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'R')
-    with cd(newdir=RPATH):
-        if catched:
-            process = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-        else:
-            process = sp.run(cmd)
-        return process
+    # cwd instead of chdir, chdir is process wide and not thread safe.
+    if catched:
+        process = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=RPATH)
+    else:
+        process = sp.run(cmd, cwd=RPATH)
+    return process
 
 
 def rscript_rot(r, toolid, update_starttime, update_endtime):
@@ -129,6 +144,197 @@ def rscript_avm(r, toolid, starttime, endtime):
     return rprocess
 
 
+class RWorker:
+    """One long lived R/worker.R process, libraries and DB connections are
+    loaded once and every call is one job line on stdin. Not thread safe,
+    use it from one thread at a time, see RWorkerPool.
+    """
+    script = 'worker.R'
+    sentinel = '@@NIKON_R_DONE@@'
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        self.process = sp.Popen(
+            ['Rscript', self.script],
+            stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.STDOUT, cwd=RPATH
+        )
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def call(self, job, toolid, update_starttime, update_endtime):
+        """run one rot/mea job
+        :types: job: str, 'rot' or 'mea'
+        :rtype: ParsedCompletedCommand, stdout is the R log of the job
+        """
+        if not self.alive():
+            self.start()
+        args = [job, toolid or '', update_starttime, update_endtime]
+        self.process.stdin.write(('\t'.join(args) + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+
+        lines = []
+        for line in iter(self.process.stdout.readline, b''):
+            line = decode_line(line)
+            if line.startswith(self.sentinel):
+                _, status, message = (line.split('\t', 2) + ['', ''])[:3]
+                return ParsedCompletedCommand(
+                    0 if status == 'ok' else 1, args, ''.join(lines), message)
+            lines.append(line + '\n')
+        # EOF before the sentinel, the worker died in this job.
+        returncode = self.process.wait()
+        self.process = None
+        return ParsedCompletedCommand(
+            returncode, args, ''.join(lines), 'R worker exited')
+
+    def close(self):
+        if not self.alive():
+            return
+        try:
+            self.process.stdin.write(b'quit\n')
+            self.process.stdin.close()
+            self.process.wait(timeout=30)
+        except (OSError, sp.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class RWorkerPool:
+    """size RWorker processes started on first use and shared by the
+    Rscript threads of execute_r_concurrency.
+    """
+
+    def __init__(self, size):
+        self.workers = [RWorker() for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def call(self, job, toolid, update_starttime, update_endtime):
+        worker = self._idle.get()
+        try:
+            return worker.call(
+                job=job,
+                toolid=toolid,
+                update_starttime=update_starttime,
+                update_endtime=update_endtime
+            )
+        except OSError:
+            # broken pipe, restart on next call
+            worker.close()
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+class WindowScheduler:
+    """Run planned windows concurrently and advance a watermark over the
+    contiguous prefix of completed windows, a later window finishing
+    first never moves the watermark past an unfinished one. After the
+    first failure the windows not started yet are cancelled.
+    """
+
+    def __init__(self, windows, workers=1):
+        self.windows = list(windows)
+        self.workers = max(1, min(workers, len(self.windows)))
+
+    def run(self, execute, advance):
+        """
+        :types: execute: callable(starttime, endtime), run in worker threads
+        :types: advance: callable(endtime), run in the calling thread in
+            window order with the end of the completed prefix
+        :rtype: end of the completed prefix, None if no window completed
+        """
+        done = set()
+        errors = OrderedDict()
+        prefix = 0
+        watermark = None
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            future_to_idx = {
+                executor.submit(execute, starttime, endtime): idx
+                for idx, (starttime, endtime) in enumerate(self.windows)
+            }
+            for future in futures.as_completed(future_to_idx):
+                if future.cancelled():
+                    continue
+                idx = future_to_idx[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    print('%r window generated an exception: %s' % (
+                        self.windows[idx], exc))
+                    errors[self.windows[idx]] = exc
+                    for pending in future_to_idx:
+                        pending.cancel()
+                    continue
+                done.add(idx)
+                while prefix in done:
+                    prefix += 1
+                if prefix and self.windows[prefix - 1][1] != watermark:
+                    watermark = self.windows[prefix - 1][1]
+                    advance(watermark)
+        if errors:
+            raise TlcdFlowError(errors=errors)
+        return watermark
+
+
+def plan_windows(starttime, endtime, seconds=None):
+    """split (starttime, endtime] into consecutive windows of seconds,
+    the last one ends at endtime. One window if seconds is None.
+    :rtype: list((start, end))
+    """
+    windows = []
+    while starttime < endtime:
+        if seconds is None:
+            window_end = endtime
+        else:
+            window_end = min(starttime + timedelta(seconds=seconds), endtime)
+        windows.append((starttime, window_end))
+        starttime = window_end
+    return windows
+
+
+def tool_starttimes(toolids, psql_lastendtime, ora_lastendtime,
+                    tool_lastendtimes=None):
+    """start of (start, ora_lastendtime] for every tool, its own watermark
+    if it is ahead of psql_lastendtime. Tools already at ora_lastendtime
+    are left out.
+    :types: tool_lastendtimes: dict(lower toolid: last_end_time) or None
+    :rtype: OrderedDict(toolid: starttime)
+    """
+    tool_lastendtimes = tool_lastendtimes or {}
+    starttimes = OrderedDict()
+    for toolid in sorted(toolids):
+        starttime = max(
+            psql_lastendtime,
+            tool_lastendtimes.get(toolid, psql_lastendtime)
+        )
+        if starttime < ora_lastendtime:
+            starttimes[toolid] = starttime
+    return starttimes
+
+
+def plan_row_windows(starttime, endtime, endtimes, rows):
+    """split (starttime, endtime] so every window holds about rows of
+    the sorted endtimes, the last one ends at endtime.
+    :rtype: list((start, end))
+    """
+    bounds = sorted(set(endtimes[rows - 1::rows]) | {endtime})
+    windows = []
+    for window_end in bounds:
+        if starttime < window_end <= endtime:
+            windows.append((starttime, window_end))
+            starttime = window_end
+    return windows
+
+
 class Base:
     """docstring for Base
     """
@@ -168,98 +374,177 @@ class Base:
             return {'ret': True, 'add': add_cols, 'del': del_cols}
 
     def clean_endtimedata(self, endtime_data):
-        mapping = [
-            'TOOLID', 'OPERATIONID', 'PRODUCTID', 'CHAMBERID',
-            'GLASSID', 'ENDTIME', 'TSTAMP', 'RECIPEID'
+        mapping = nikon.ENDTIME_COLUMNS
+        logintime = (datetime.now(),)
+        if getattr(endtime_data, 'columns', None) == mapping:
+            # Rows already come in index_glassout column order.
+            return [row + logintime for row in endtime_data.rows]
+        return [
+            tuple(d[i] for i in mapping) + logintime
+            for d in endtime_data
         ]
-        insert_data = []
-        logintime = datetime.now()
-        for d in endtime_data:
-            value_order = [d[i] for i in mapping]
-            d = OrderedDict(zip(mapping, value_order))
-            d.setdefault('LOGIN_TIME', logintime)
-            insert_data.append(tuple(d.values()))
-        return insert_data
+
+    def column_projection(self, edc_columns, schemacolnames):
+        """build a getter which turns a raw edc row tuple into a tuple
+        in PG column order, matched by column name.
+        :types: edc_columns: list(str), edc column names in fetch order
+        :types: schemacolnames: list(str), PG column names in table order
+        :rtype: callable(tuple) -> tuple, None if PG has columns edc lacks
+        """
+        column_state = self.column_state(
+            edc=edc_columns, schema=schemacolnames)
+        print('Check column status: ret={} add={} del={}'.format(
+            column_state.get('ret'), column_state.get('add'),
+            column_state.get('del')
+        ))
+        if not column_state.get('ret', False):
+            return None
+        if len(column_state.get('add')):
+            print('Add cols: {}, remove those.'.format(
+                len(column_state.get('add'))))
+
+        index = {column: idx for idx, column in enumerate(edc_columns)}
+        positions = [index[column] for column in schemacolnames]
+        if len(positions) == 1:
+            position = positions[0]
+            return lambda row: (row[position],)
+        return itemgetter(*positions)
 
     def clean_edcdata(self, edc_data, schemacolnames):
         datas = []
         if len(edc_data):
             edc_columns = list(edc_data[0].keys())
-            column_state = self.column_state(
-                edc=edc_columns, schema=schemacolnames)
-            print('Check column status: ret={} add={} del={}'.format(
-                column_state.get('ret'), column_state.get('add'),
-                column_state.get('del')
-            ))
-            if column_state.get('ret', False):
-                add_cols = column_state.get('add')
-                if len(add_cols):
-                    print('Add cols: {}, remove those.'.format(
-                        len(column_state.get('add'))))
-                    for d in edc_data:
-                        for c in add_cols:
-                            del d[c]
-                    print('Check again: {}.'.format(self.column_state(
-                        edc=edc_data[0], schema=schemacolnames)))
-                    datas = [tuple(d.values()) for d in edc_data if d]
-                else:
-                    datas = [tuple(d.values()) for d in edc_data]
+            project = self.column_projection(
+                edc_columns=edc_columns, schemacolnames=schemacolnames)
+            if project is not None:
+                datas = [project(tuple(d.values())) for d in edc_data]
             print('Insert clean_edcdata Count: {}'.format(len(datas)))
         return datas
 
+    def clean_edcrows(self, rows, project):
+        """apply a column_projection to raw edc row tuples
+        """
+        return list(map(project, rows))
+
     def clean_schemacolnames(self, schemacolnames):
         return [column[0].upper()
                 for column in schemacolnames]
 
 
 class BaseInsert:
+    """Staged asyncio pipeline, Oracle reader -> cleaner -> PG writer.
+    Stages are linked by bounded queues, so the reader fetches the next
+    batch while the writer loads the current one. Blocking DB calls of
+    the reader and the writer run on their own single thread. The reader
+    has its own Oracle session, the writer works on the PG connection of
+    the calling thread through self.fdc_psql, so its writes join a
+    transaction() the caller has open.
+    """
 
-    @asyncio.coroutine
-    def insert(self, toolid):
+    async def read_stage(self, executor, batches, queue):
+        loop = asyncio.get_event_loop()
         while True:
-            row = yield
-            if row is None:
+            batch = await loop.run_in_executor(executor, next, batches, None)
+            if batch is None:
                 break
-            # print('Insert: {}'.format(row))
-            self.fdc_psql.save_edcdata(
-                toolid=toolid,
-                edcdata=row
-            )
+            await queue.put(batch)
+        await queue.put(None)
 
-    @asyncio.coroutine
-    def grouper(self, toolid):
+    async def clean_stage(self, clean, inqueue, outqueue):
         while True:
-            yield from self.insert(toolid=toolid)
-
-    def insert_main(self, toolid, datas):
-        for idx, values in enumerate(datas):
-            group = self.grouper(toolid=toolid)
-            next(group)
-            group.send(values)
-        group.send(None)
-
-    @asyncio.coroutine
-    def insert_endtimedata(self):
-        while True:
-            row = yield
-            if row is None:
+            batch = await inqueue.get()
+            if batch is None:
                 break
-            # print('Insert: {}'.format(row))
-            self.fdc_psql.save_endtime(
-                endtime_data=row
-            )
+            datas = clean(batch)
+            if len(datas):
+                await outqueue.put(datas)
+        await outqueue.put(None)
+
+    async def write_stage(self, executor, write, queue, finish=None):
+        loop = asyncio.get_event_loop()
+        fdc_psql = self.fdc_psql
+        transaction = fdc_psql.transaction(commit_every=self.commit_every)
+        entered = []
+
+        def begin():
+            transaction.__enter__()
+            entered.append(True)
+
+        def end(*exc_info):
+            # the executor is FIFO, begin() has run or was never started
+            if entered:
+                transaction.__exit__(*exc_info)
 
-    @asyncio.coroutine
-    def endtimedata_grouper(self):
-        while True:
-            yield from self.insert_endtimedata()
-
-    def insert_endtimedata_main(self, datas):
-        for idx, values in enumerate(datas):
-            group = self.endtimedata_grouper()
-            next(group)
-            group.send(values)
-        group.send(None)
+        count = 0
+        try:
+            await loop.run_in_executor(executor, begin)
+            while True:
+                datas = await queue.get()
+                if datas is None:
+                    break
+                await loop.run_in_executor(
+                    executor, write, fdc_psql, datas, count)
+                count += len(datas)
+            if finish is not None and count:
+                await loop.run_in_executor(executor, finish, fdc_psql)
+        except BaseException as exc:
+            # CancelledError too, the pipeline cancels the writer when
+            # another stage fails. The transaction has to end anyway.
+            await asyncio.shield(loop.run_in_executor(
+                executor, end, type(exc), exc, exc.__traceback__))
+            raise
+        await loop.run_in_executor(executor, end, None, None, None)
+        return count
+
+    async def pipeline(self, batches, clean, write, finish=None):
+        reader = futures.ThreadPoolExecutor(max_workers=1)
+        writer = futures.ThreadPoolExecutor(max_workers=1)
+        raw_queue = asyncio.Queue(maxsize=self.queue_size)
+        clean_queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_event_loop()
+        # the caller waits in run_until_complete, its connection is free
+        conn = db_pg.current()
+        await loop.run_in_executor(writer, db_pg.attach, conn)
+        tasks = [
+            asyncio.ensure_future(
+                self.read_stage(reader, batches, raw_queue)),
+            asyncio.ensure_future(
+                self.clean_stage(clean, raw_queue, clean_queue)),
+            asyncio.ensure_future(
+                self.write_stage(writer, write, clean_queue, finish)),
+        ]
+        try:
+            done = await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            await loop.run_in_executor(reader, db_fdc.release)
+            await loop.run_in_executor(writer, db_pg.detach, conn)
+            reader.shutdown()
+            writer.shutdown()
+        return done[-1]
+
+    def pipeline_main(self, batches, clean, write, finish=None):
+        """run pipeline on a private event loop
+        :types: batches: iterator of Oracle row batches
+        :types: clean: callable(batch) -> list of tuples
+        :types: write: callable(fdc_psql, datas, count), count is the
+            number of rows written before this batch
+        :types: finish: callable(fdc_psql), run after the last write in
+            the same transaction if any row was written
+        :rtype: int, written row count
+        Writes commit with the transaction() of self.fdc_psql if one is
+        open, else on their own when the pipeline ends.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.pipeline(
+                batches=batches, clean=clean, write=write, finish=finish))
+        finally:
+            loop.close()
 
 
 class ETL(Base, BaseInsert):
@@ -276,12 +561,38 @@ class ETL(Base, BaseInsert):
         ```
     """
 
-    def __init__(self, toolid):
+    def __init__(self, toolid, batch_size=nikon.COPY_BATCH_SIZE,
+                 commit_every=None, fetch_size=nikon.FETCH_ARRAYSIZE,
+                 workers=1, queue_size=2, chunk_seconds=None,
+                 chunk_rows=None, merge=False, r_workers=1,
+                 rot_engine='r', r_persistent=False, window_workers=1,
+                 avm_window_seconds=ROT_WINDOW_SECONDS, per_tool=False,
+                 keyset=False, disk_cache=False):
         super(ETL, self).__init__()
         self.fdc_psql = nikon.FdcPGSQL()
         self.fdc_oracle = nikon.FdcOracle()
         self.eda_oracle = nikon.EdaOracle()
         self.toolid = toolid
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.fetch_size = fetch_size
+        self.workers = min(MAX_WORKER, workers)
+        self.queue_size = queue_size
+        self.chunk_seconds = chunk_seconds
+        self.chunk_rows = chunk_rows
+        self.merge = merge
+        self.r_workers = min(R_MAX_WORKER, r_workers)
+        self.rot_engine = rot_engine
+        self.r_persistent = r_persistent
+        self.r_pool = None
+        self.window_workers = window_workers
+        self.avm_window_seconds = avm_window_seconds
+        self.per_tool = per_tool
+        self.keyset = keyset
+        self.window_cache = window_cache.WindowCache() if disk_cache else None
+        # Oracle lastendtime of the run, cached windows fetched under
+        # another one are dropped.
+        self.source_watermark = None
 
     def get_aplastendtime(self, apname):
         row = self.fdc_psql.get_lastendtime(
@@ -296,6 +607,7 @@ class ETL(Base, BaseInsert):
         Nikon ETL process
         """
         print('Nikon ETL Process Start...')
+        nikon.schema_cache.invalidate()
         row = self.get_aplastendtime(apname=apname)
         etlflow = self.check_flow(row=row)
         if etlflow:
@@ -304,123 +616,447 @@ class ETL(Base, BaseInsert):
         # Get lastendtime
         ora_lastendtime = self.fdc_oracle.get_lastendtime()[0]
         psql_lastendtime = self.get_lastendtime(row=row)
+        self.source_watermark = ora_lastendtime
         print('Lastendtime, Oracle:{}, PSQL:{}'.format(
             ora_lastendtime, psql_lastendtime))
 
-        # Get toolids
-        toolids = self.dbtransfer(
-            apname=apname,
-            ora_lastendtime=ora_lastendtime,
-            psql_lastendtime=psql_lastendtime
+        # NIKON is the minimum of the per-tool watermarks
+        tool_lastendtimes = None
+        if self.per_tool:
+            tool_lastendtimes = self.fdc_psql.get_lastendtimes(apname=apname)
+            print('Per-tool lastendtime: {}'.format(len(tool_lastendtimes)))
+
+        windows = self.plan_edc_windows(
+            psql_lastendtime=psql_lastendtime,
+            ora_lastendtime=ora_lastendtime
         )
-        # Insert for loop
-        try:
+        for idx, (window_start, window_end) in enumerate(windows, 1):
+            print('EDC window {}/{}, start: {}, end: {}.'.format(
+                idx, len(windows), window_start, window_end))
+            self.etl_window(
+                apname=apname,
+                psql_lastendtime=window_start,
+                ora_lastendtime=window_end,
+                tool_lastendtimes=tool_lastendtimes
+            )
+
+    def plan_edc_windows(self, psql_lastendtime, ora_lastendtime):
+        """split (psql_lastendtime, ora_lastendtime] into sub-windows of
+        chunk_seconds, or of chunk_rows index_glassout rows.
+        :rtype: list((start, end))
+        """
+        if self.chunk_rows:
+            endtimes = self.fdc_oracle.get_endtimes(
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime
+            )
+            return plan_row_windows(
+                starttime=psql_lastendtime,
+                endtime=ora_lastendtime,
+                endtimes=endtimes,
+                rows=self.chunk_rows
+            )
+        if self.chunk_seconds:
+            return plan_windows(
+                starttime=psql_lastendtime,
+                endtime=ora_lastendtime,
+                seconds=self.chunk_seconds
+            )
+        return plan_windows(
+            starttime=psql_lastendtime,
+            endtime=ora_lastendtime
+        )
+
+    def etl_window(self, apname, psql_lastendtime, ora_lastendtime,
+                   tool_lastendtimes=None):
+        """import one window and checkpoint the watermark to its end
+        :types: tool_lastendtimes: dict(toolid: last_end_time) of per_tool,
+            updated in place
+        """
+        if tool_lastendtimes is not None:
+            return self.etl_window_per_tool(
+                apname=apname,
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime,
+                tool_lastendtimes=tool_lastendtimes
+            )
+
+        # Swap the window and move the watermark in one transaction.
+        # Sequential tools write in it too. Tools of tlcd_flow_concurrency
+        # commit on their own sessions, so a rolled back window may leave
+        # them loaded; the re-run deletes and copies (or merges) the same
+        # window again, which is idempotent.
+        with self.fdc_psql.transaction(commit_every=self.commit_every):
+            # Get toolids
+            toolids = self.dbtransfer(
+                apname=apname,
+                ora_lastendtime=ora_lastendtime,
+                psql_lastendtime=psql_lastendtime
+            )
+            # Insert for loop
             self.tlcd_flow(
                 toolids=toolids,
                 apname=apname,
                 psql_lastendtime=psql_lastendtime,
                 ora_lastendtime=ora_lastendtime
             )
-        except Exception as e:
-            raise e
 
-        # Update Nikon lastendtime.
-        try:
-            print('Update {} lastendtime, apname {}'.format(self.toolid, apname))
+            # Update Nikon lastendtime.
+            print('Update {} lastendtime, apname {}'.format(
+                self.toolid, apname))
             self.fdc_psql.update_lastendtime(
                 toolid=self.toolid,
                 apname=apname,
                 last_endtime=ora_lastendtime
             )
-        except Exception as e:
-            raise e
+
+    def etl_window_per_tool(self, apname, psql_lastendtime, ora_lastendtime,
+                            tool_lastendtimes):
+        """etl_window with a watermark per tool. A tool only copies after
+        its own watermark, and every tool that did not fail moves to the
+        window end, tools without rows in the window included. NIKON is
+        then the minimum, so a failed tool is retried from its watermark.
+        """
+        errors = None
+        with self.fdc_psql.transaction(commit_every=self.commit_every):
+            toolids = self.dbtransfer(
+                apname=apname,
+                ora_lastendtime=ora_lastendtime,
+                psql_lastendtime=psql_lastendtime
+            )
+            try:
+                self.tlcd_flow(
+                    toolids=toolids,
+                    apname=apname,
+                    psql_lastendtime=psql_lastendtime,
+                    ora_lastendtime=ora_lastendtime,
+                    tool_lastendtimes=tool_lastendtimes
+                )
+            except TlcdFlowError as e:
+                errors = e
+
+            known = set(tool_lastendtimes) | set(toolids) | set(
+                toolid.lower() for toolid in nikon.schema_cache.toolids())
+            advanced = {
+                toolid: ora_lastendtime
+                for toolid in known - set(errors.errors if errors else ())
+                if tool_lastendtimes.get(toolid, psql_lastendtime) <
+                ora_lastendtime
+            }
+            print('Update {} per-tool lastendtime: {}, failed: {}'.format(
+                apname, len(advanced), len(errors.errors) if errors else 0))
+            self.fdc_psql.update_lastendtimes(
+                apname=apname,
+                last_endtimes=advanced
+            )
+            self.fdc_psql.derive_lastendtime(
+                toolid=self.toolid,
+                apname=apname
+            )
+        tool_lastendtimes.update(advanced)
+        if errors:
+            raise errors
+
+    def cached_batches(self, key, starttime, endtime, batches):
+        """batches of one window from the disk window cache. On a miss
+        batches stream through unchanged and are stored on the way.
+        Unchanged batches without disk_cache.
+        :types: batches: iterator of ResultSet, only read on a miss
+        :rtype: iterator of ResultSet
+        """
+        if self.window_cache is None or self.source_watermark is None:
+            return batches
+        return self.window_cache.fetch(
+            toolid=key,
+            starttime=starttime,
+            endtime=endtime,
+            watermark=self.source_watermark,
+            batches=batches
+        )
 
     def dbtransfer(self, apname, ora_lastendtime, psql_lastendtime):
         """start to copy index_glassout table
         """
         print('Transfer index_glassot table from Oracle to PostgresSQL.')
-        toolids = []
+        toolids = set()
         # ora lastendtime new than psql lastendtime.
         if ora_lastendtime > psql_lastendtime:
-            endtime_data = self.fdc_oracle.get_endtimedata(
-                psql_lastendtime=psql_lastendtime,
-                ora_lastendtime=ora_lastendtime
+            batches = self.cached_batches(
+                key='index_glassout',
+                starttime=psql_lastendtime,
+                endtime=ora_lastendtime,
+                batches=self.fdc_oracle.iter_endtimedata(
+                    psql_lastendtime=psql_lastendtime,
+                    ora_lastendtime=ora_lastendtime,
+                    arraysize=self.fetch_size
+                )
             )
-            if len(endtime_data):
-                try:
-                    print('Delete interval index_glassot rows')
-                    self.fdc_psql.delete_tlcd(
+            count = 0
+            with self.fdc_psql.transaction(commit_every=self.commit_every):
+                for endtime_data in batches:
+                    # Add logintime in all row.
+                    insert_datas = self.clean_endtimedata(
+                        endtime_data=endtime_data)
+                    if self.merge:
+                        if not count:
+                            self.fdc_psql.create_stage(table='index_glassout')
+                        self.fdc_psql.copy_stage(
+                            table='index_glassout',
+                            rows=insert_datas,
+                            batch_size=self.batch_size
+                        )
+                    else:
+                        if not count:
+                            print('Delete interval index_glassot rows')
+                            self.fdc_psql.delete_tlcd(
+                                psql_lastendtime=psql_lastendtime,
+                                ora_lastendtime=ora_lastendtime
+                            )
+                        self.fdc_psql.copy_endtime(
+                            endtime_datas=insert_datas,
+                            batch_size=self.batch_size
+                        )
+                    count += len(insert_datas)
+
+                    # Import data in table
+                    toolid_idx = endtime_data.index['TOOLID']
+                    toolids.update(row[toolid_idx].lower()
+                                   for row in endtime_data.rows)
+
+                if self.merge and count:
+                    merged = self.fdc_psql.merge_stage(
+                        table='index_glassout',
+                        columns=nikon.INDEX_GLASSOUT_COLUMNS,
+                        keys=['toolid', 'glassid', 'tstamp'],
+                        window_column='endtime',
                         psql_lastendtime=psql_lastendtime,
-                        ora_lastendtime=ora_lastendtime
+                        ora_lastendtime=ora_lastendtime,
+                        compare=nikon.INDEX_GLASSOUT_COLUMNS[:-1],
+                        where='AND t."toolid" LIKE %(tlcd)s',
+                        params={'tlcd': 'TLCD__01'}
                     )
-                except Exception as e:
-                    raise e
-
-                # Add logintime in all row.
-                insert_datas = self.clean_endtimedata(
-                    endtime_data=endtime_data)
-                print('Total interval cleandata count= {}'.format(
-                    len(insert_datas)))
-
-                try:
-                    print('Save interval cleandata into index_glassout')
-                    self.insert_endtimedata_main(datas=insert_datas)
-                    print('Done')
-                except Exception as e:
-                    raise e
-
-                # Import data in table
-                toolids = list(set(data['TOOLID'].lower()
-                                   for data in endtime_data))
+                    print('Merge index_glassout: {}'.format(merged))
+            print('Total interval cleandata count= {}'.format(count))
 
+        toolids = list(toolids)
         print('Toolids: {}.'.format(toolids))
         return toolids
 
-    def tlcd_flow(self, toolids, apname, psql_lastendtime, ora_lastendtime):
-        """start to copy tlcd table
+    def tlcd_flow(self, toolids, apname, psql_lastendtime, ora_lastendtime,
+                  tool_lastendtimes=None):
+        """start to copy tlcd table. Failed tools raise TlcdFlowError,
+        with tool_lastendtimes after every tool was tried, each in its own
+        savepoint (no commit_every group commits inside one).
+        :types: tool_lastendtimes: dict(toolid: last_end_time), a tool
+            starts from its own watermark if it is ahead
+        :rtype: OrderedDict(toolid: inserted row count)
         """
-        print('Start sequential copy tlcd table.')
+        result = OrderedDict()
         # ora lastendtime new than psql lastendtime.
-        if ora_lastendtime > psql_lastendtime:
-            for toolid in sorted(toolids):
-                # check table exists or not.
-                pgclass = self.fdc_psql.get_pgclass(toolid=toolid)
-                print('Toolid: {}, pg_class count: {}'.format(toolid, pgclass))
-
-                if pgclass[0]['count']:
-                    print('Reday to Import EDC toolid: {}'.format(toolid))
-                    schemacolnames = self.fdc_psql.get_schemacolnames(
-                        toolid=toolid
-                    )
-                    schemacolnames = self.clean_schemacolnames(
-                        schemacolnames=schemacolnames
-                    )
-                    edc_data = self.fdc_oracle.get_edcdata(
+        if ora_lastendtime <= psql_lastendtime:
+            return result
+        starttimes = tool_starttimes(
+            toolids=toolids,
+            psql_lastendtime=psql_lastendtime,
+            ora_lastendtime=ora_lastendtime,
+            tool_lastendtimes=tool_lastendtimes
+        )
+        if self.workers > 1 and len(starttimes) > 1:
+            return self.tlcd_flow_concurrency(
+                toolids=list(starttimes),
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime,
+                starttimes=starttimes
+            )
+
+        print('Start sequential copy tlcd table.')
+        errors = OrderedDict()
+        for toolid, starttime in starttimes.items():
+            try:
+                if tool_lastendtimes is None:
+                    result[toolid] = self.tlcd_tool(
                         toolid=toolid,
-                        psql_lastendtime=psql_lastendtime,
+                        psql_lastendtime=starttime,
                         ora_lastendtime=ora_lastendtime
                     )
-                    print('Total {} Count: {}'.format(toolid, len(edc_data)))
-                    datas = self.clean_edcdata(
-                        edc_data=edc_data,
-                        schemacolnames=schemacolnames
-                    )
+                else:
+                    # per-tool watermarks, a failed tool only rolls back
+                    # its own writes
+                    with self.fdc_psql.savepoint():
+                        result[toolid] = self.tlcd_tool(
+                            toolid=toolid,
+                            psql_lastendtime=starttime,
+                            ora_lastendtime=ora_lastendtime
+                        )
+            except Exception as exc:
+                print('%r generated an exception: %s' % (toolid, exc))
+                errors[toolid] = exc
+                if tool_lastendtimes is None:
+                    # the whole window rolls back, skip the other tools
+                    break
+            print('Next toolid')
+        if errors:
+            raise TlcdFlowError(errors=errors, result=result)
+        return result
+
+    def tlcd_flow_concurrency(self, toolids, psql_lastendtime,
+                              ora_lastendtime, starttimes=None):
+        """copy tlcd tables in parallel, one tool per worker thread.
+        Every tool is tried; failed tools raise TlcdFlowError at the end.
+        Each tool commits in its own session, independent of the caller
+        transaction (at-least-once, see etl_window).
+        :types: starttimes: dict(toolid: starttime), default psql_lastendtime
+        :rtype: OrderedDict(toolid: inserted row count)
+        """
+        starttimes = starttimes or {}
+        workers = min(self.workers, len(toolids))
+        print('Start concurrent copy tlcd table, workers: {}.'.format(workers))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_toolid = {
+                executor.submit(
+                    self._tlcd_tool_session, toolid,
+                    starttimes.get(toolid, psql_lastendtime),
+                    ora_lastendtime): toolid
+                for toolid in sorted(toolids)
+            }
+            result = OrderedDict()
+            errors = OrderedDict()
+            for future in futures.as_completed(future_to_toolid):
+                toolid = future_to_toolid[future]
+                try:
+                    result[toolid] = future.result()
+                except Exception as exc:
+                    print('%r generated an exception: %s' % (toolid, exc))
+                    errors[toolid] = exc
+                else:
+                    print('%r toolid has %d rows' % (toolid, result[toolid]))
+        if errors:
+            raise TlcdFlowError(errors=errors, result=result)
+        return result
 
-                    if len(datas) != 0:
-                        try:
-                            print('Delete interval tlcd rows duplicate...')
-                            self.fdc_psql.delete_toolid(
-                                toolid=toolid,
-                                psql_lastendtime=psql_lastendtime,
-                                ora_lastendtime=ora_lastendtime
-                            )
-                            print('Insert {} row'.format(toolid))
-                            # Using coroutine to add high performance.
-                            self.insert_main(toolid=toolid, datas=datas)
-                            print('Done')
-                        except Exception as e:
-                            raise e
-                print('Next toolid')
+    def _tlcd_tool_session(self, toolid, psql_lastendtime, ora_lastendtime):
+        """run tlcd_tool with its own ETL, Oracle and PG sessions
+        """
+        etl = ETL(
+            toolid=self.toolid,
+            batch_size=self.batch_size,
+            commit_every=self.commit_every,
+            fetch_size=self.fetch_size,
+            queue_size=self.queue_size,
+            merge=self.merge,
+            keyset=self.keyset
+        )
+        etl.window_cache = self.window_cache
+        etl.source_watermark = self.source_watermark
+        try:
+            return etl.tlcd_tool(
+                toolid=toolid,
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime
+            )
+        finally:
+            db_fdc.release()
+            db_pg.release()
+
+    def tlcd_tool(self, toolid, psql_lastendtime, ora_lastendtime):
+        """copy one tlcd table, batch by batch as Oracle returns rows
+        :rtype: int, inserted row count
+        """
+        # check table exists or not.
+        if not nikon.schema_cache.exists(toolid):
+            print('Toolid: {}, no rawdata table'.format(toolid))
+            return 0
+
+        print('Reday to Import EDC toolid: {}'.format(toolid))
+        schemacolnames = nikon.schema_cache.schemacolnames(toolid)
+        schemacolnames = self.clean_schemacolnames(
+            schemacolnames=schemacolnames
+        )
+        if self.keyset:
+            # pages of fetch_size rows, a failed page resumes from its key
+            batches = self.fdc_oracle.keyset_edcdata(
+                toolid=toolid,
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime,
+                page_size=self.fetch_size
+            ).pages()
+        else:
+            batches = self.fdc_oracle.iter_edcdata(
+                toolid=toolid,
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime,
+                arraysize=self.fetch_size
+            )
+
+        batches = self.cached_batches(
+            key=toolid,
+            starttime=psql_lastendtime,
+            endtime=ora_lastendtime,
+            batches=batches
+        )
+
+        projection = {}
+
+        def clean(batch):
+            # Columns are the same for every batch of one query.
+            if 'project' not in projection:
+                projection['project'] = self.column_projection(
+                    edc_columns=batch.columns,
+                    schemacolnames=schemacolnames
+                )
+            if projection['project'] is None:
+                return []
+            return self.clean_edcrows(
+                rows=batch.rows,
+                project=projection['project']
+            )
+
+        table = '{}_rawdata'.format(toolid)
+
+        def write(fdc_psql, datas, count):
+            if self.merge:
+                if not count:
+                    fdc_psql.create_stage(table=table)
+                fdc_psql.copy_stage(
+                    table=table,
+                    rows=datas,
+                    batch_size=self.batch_size
+                )
+                return
+            if not count:
+                print('Delete interval tlcd rows duplicate...')
+                fdc_psql.delete_toolid(
+                    toolid=toolid,
+                    psql_lastendtime=psql_lastendtime,
+                    ora_lastendtime=ora_lastendtime
+                )
+            # Bulk load with COPY, one round trip per batch.
+            fdc_psql.copy_edcdata(
+                toolid=toolid,
+                edcdatas=datas,
+                batch_size=self.batch_size
+            )
+
+        def finish(fdc_psql):
+            merged = fdc_psql.merge_stage(
+                table=table,
+                columns=[column[0] for column in
+                         nikon.schema_cache.schemacolnames(toolid)],
+                keys=['glassid', 'tstamp'],
+                window_column='tstamp',
+                psql_lastendtime=psql_lastendtime,
+                ora_lastendtime=ora_lastendtime
+            )
+            print('Merge {}: {}'.format(toolid, merged))
+
+        count = self.pipeline_main(
+            batches=batches,
+            clean=clean,
+            write=write,
+            finish=finish if self.merge else None
+        )
+        print('Insert {} Count: {}'.format(toolid, count))
+        return count
 
     @logger.patch
     def rot(self, apname_rot, apname_edc, *args, **kwargs):
@@ -428,6 +1064,8 @@ class ETL(Base, BaseInsert):
         Nikon ROT process
         """
         print("Nikon ETL ROT Transform Process Start...")
+        nikon.schema_cache.invalidate()
+        nikon.measrot_cache.evict()
         row = self.get_aplastendtime(apname=apname_rot)
         edcrow = self.get_aplastendtime(apname=apname_edc)
         
@@ -448,61 +1086,106 @@ class ETL(Base, BaseInsert):
                   update_starttime, update_endtime
               ))
         
-        count = 0
-        while True:
-            # stop if update_starttime same.
-            if update_starttime == psql_lastendtime_edc:
-                print('Update starttime = psql lastendtime, Done')
-                break
+        windows = plan_windows(
+            update_starttime, update_endtime, seconds=ROT_WINDOW_SECONDS)
+        print('ROT windows: {}, window_workers: {}'.format(
+            len(windows), self.window_workers))
 
-            # TODO short term to break, should remark in product.
-            if count == 30:
-                print('Exit while loop, execute more then {} times.'.format(count))
-                break
-
-            if (update_starttime + timedelta(seconds=86400)) < psql_lastendtime_edc:
-                update_endtime = update_starttime + timedelta(seconds=86400)
-            else:
-                update_endtime = psql_lastendtime_edc
+        advanced = []
 
-            print('Update Start Time: {}, '
-                  'Update End Time: {}.'.format(update_starttime, update_endtime))
-
-            # Get candidates of toolist
-            toolist = self.fdc_psql.get_toolid(
-                update_starttime=update_starttime,
-                update_endtime=update_endtime
+        def advance(last_endtime):
+            print('Update ROT_Transform lastendtime: {}'.format(last_endtime))
+            self.fdc_psql.update_lastendtime(
+                toolid=self.toolid,
+                apname=apname_rot,
+                last_endtime=last_endtime
             )
-            toolids = list(chain.from_iterable(toolist))
-            print(toolids)
+            advanced.append(last_endtime)
 
-            # ROT for loop
-            try:
-                update_starttime = self.rot_flow(
-                    toolids=toolids,
-                    update_starttime=update_starttime,
-                    update_endtime=update_endtime
-                )
-            except Exception as e:
-                raise e
-            count += 1
+        if self.r_persistent:
+            self.r_pool = RWorkerPool(size=self.r_workers)
+        try:
+            WindowScheduler(
+                windows=windows,
+                workers=self.window_workers
+            ).run(execute=self._rot_window_session, advance=advance)
+        finally:
+            if self.r_pool is not None:
+                self.r_pool.close()
+                self.r_pool = None
+            # once for the whole backfill instead of once per window, also
+            # when a later window failed after others advanced
+            if advanced:
+                print('Refresh MTV (tlcd_nikon_mea_process_summary_mv) '
+                      'in the end"')
+                self.fdc_psql.refresh_nikonmea()
+
+        if not windows:
+            print('Update starttime = psql lastendtime, Done')
 
-        # Update lastendtime for ROT_Transform and return
+    def _rot_window_session(self, update_starttime, update_endtime):
+        """rot_window with its own ETL and PG session, the R worker pool
+        is shared.
+        """
+        etl = ETL(
+            toolid=self.toolid,
+            fetch_size=self.fetch_size,
+            r_workers=self.r_workers,
+            rot_engine=self.rot_engine,
+            keyset=self.keyset
+        )
+        etl.r_pool = self.r_pool
         try:
-            print('Update ROT_Transform lastendtime')
-            self.fdc_psql.update_lastendtime(
-                toolid=self.toolid,
-                apname=apname_rot,
-                last_endtime=update_endtime
+            return etl.rot_window(
+                update_starttime=update_starttime,
+                update_endtime=update_endtime
             )
-        except Exception as e:
-            raise e
+        finally:
+            db_pg.release()
 
-    def rot_flow(self, toolids, update_starttime, update_endtime):
+    def rot_window(self, update_starttime, update_endtime):
+        """ROT of the candidate toolids of one window
         """
+        print('Update Start Time: {}, '
+              'Update End Time: {}.'.format(update_starttime, update_endtime))
+
+        # Get candidates of toolist
+        toolist = self.fdc_psql.get_toolid(
+            update_starttime=update_starttime,
+            update_endtime=update_endtime,
+            rawdata_toolids=nikon.schema_cache.toolids()
+        )
+        toolids = list(chain.from_iterable(toolist))
+        print(toolids)
+
+        return self.rot_flow(
+            toolids=toolids,
+            update_starttime=update_starttime,
+            update_endtime=update_endtime,
+            refresh=False
+        )
+
+    def rot_flow(self, toolids, update_starttime, update_endtime,
+                 refresh=True):
+        """ROT and ROT Mea of every candidate toolid in the window, the
+        Rscript jobs run concurrently up to r_workers.
+        With rot_engine 'python' ROT and ROT Mea are solved in process by
+        nikonrot instead of Rscript.
+        :types: refresh: bool, refresh tlcd_nikon_mea_process_summary_mv
         """
-        print('Start sequential copy rot tlcd table')
-        # ROT Transform
+        print('Start rot tlcd table, r_workers: {}'.format(self.r_workers))
+        # ROT Mea rows do not depend on toolid, fetched once per window
+        measrot_data = nikon.measrot_cache.get(
+            update_starttime=update_starttime,
+            update_endtime=update_endtime
+        )
+        print('ROT Transform start Meas Candidate count {}, equip: {}'.format(
+            len(measrot_data),
+            len(nikon.measrot_cache.by_equip(
+                update_starttime=update_starttime,
+                update_endtime=update_endtime))
+        ))
+        rot_toolids = []
         for toolid in sorted([id.lower() for id in toolids]):
             print('Candidate {} time period '
                   'start: {}, end: {}.'.format(
@@ -512,40 +1195,91 @@ class ETL(Base, BaseInsert):
             nikonrot_data = self.fdc_psql.get_nikonrot(
                 toolid=toolid,
                 update_starttime=update_starttime,
-                update_endtime=update_endtime
+                update_endtime=update_endtime,
+                page_size=self.fetch_size if self.keyset else None
             )
             print('ROT Candidate count: {}'.format(
                 len(nikonrot_data)
             ))
             if len(nikonrot_data):
-                rotlog = self.execute_r_rot(
+                rot_toolids.append(toolid)
+        # ROT Mea runs once per window, mea.R takes no toolid
+        mea = bool(toolids) and bool(len(measrot_data))
+
+        if self.rot_engine == 'python':
+            for toolid in rot_toolids:
+                nikonrot.rot_main(
+                    fdc_psql=self.fdc_psql,
                     toolid=toolid,
                     update_starttime=update_starttime,
-                    update_endtime=update_endtime
+                    update_endtime=update_endtime,
+                    page_size=self.fetch_size if self.keyset else None
+                )
+            if mea:
+                nikonrot.mea_main(
+                    fdc_psql=self.fdc_psql,
+                    eda_oracle=self.eda_oracle,
+                    update_starttime=update_starttime,
+                    update_endtime=update_endtime,
+                    rawdata=measrot_data
                 )
-            # ROT Mea
-            measrot_data = self.eda_oracle.get_measrotdata(
+        else:
+            jobs = [(self.execute_r_rot, toolid) for toolid in rot_toolids]
+            if mea:
+                jobs.append((self.execute_r_rotmea, self.toolid))
+            self.execute_r_concurrency(
+                jobs=jobs,
                 update_starttime=update_starttime,
                 update_endtime=update_endtime
             )
-            print('ROT Transform start Meas Candidate count {}'.format(
-                len(measrot_data)
-            ))
-            if len(measrot_data):
-                rotmeslog = self.execute_r_rotmea(
-                    toolid=toolid,
-                    update_starttime=update_starttime,
-                    update_endtime=update_endtime
-                )
 
-            # TODO which sql command call to data integration??
-            try:
-                print('Refresh MTV (tlcd_nikon_mea_process_summary_mv) in the end"')
-                self.fdc_psql.refresh_nikonmea()
-            except Exception as e:
-                raise e
+        # the window is done, later windows never ask for it again
+        nikon.measrot_cache.evict(
+            update_starttime=update_starttime,
+            update_endtime=update_endtime
+        )
+
+        # TODO which sql command call to data integration??
+        if refresh:
+            print('Refresh MTV (tlcd_nikon_mea_process_summary_mv) '
+                  'in the end"')
+            self.fdc_psql.refresh_nikonmea()
         return (update_endtime)
 
+    def execute_r_concurrency(self, jobs, update_starttime, update_endtime):
+        """run Rscript jobs in a pool of r_workers threads, every job
+        is one Rscript process.
+        :types: jobs: list((execute_r_rot or execute_r_rotmea, toolid)),
+            execute_r_rotmea is one job per window keyed by self.toolid
+        :rtype: OrderedDict(execute name: OrderedDict(toolid:
+            ParsedCompletedCommand))
+        """
+        result = OrderedDict(
+            (execute.__name__, OrderedDict()) for execute, _ in jobs)
+        if not jobs:
+            return result
+        workers = min(self.r_workers, len(jobs))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_job = {
+                executor.submit(
+                    execute, toolid=toolid,
+                    update_starttime=update_starttime,
+                    update_endtime=update_endtime): (execute.__name__, toolid)
+                for execute, toolid in jobs
+            }
+            errors = OrderedDict()
+            for future in futures.as_completed(future_to_job):
+                name, toolid = future_to_job[future]
+                try:
+                    result[name][toolid] = future.result()
+                except Exception as exc:
+                    print('%r %s generated an exception: %s' % (
+                        toolid, name, exc))
+                    errors[(name, toolid)] = exc
+        if errors:
+            raise TlcdFlowError(errors=errors)
+        return result
+
     @logger.patch
     def avm(self, apname, *args, **kwargs):
         """start etl avm
@@ -556,71 +1290,104 @@ class ETL(Base, BaseInsert):
         lastendtime_rot = self.get_lastendtime(row=row_rot)
         lastendtime_avm = self.get_lastendtime(row=row_avm)
 
-        if lastendtime_rot > lastendtime_avm:
-            starttime = lastendtime_avm
-            # endtime = lastendtime_rot
-
-        while True:
-            if starttime >= lastendtime_rot:
-                break
+        # avm_window_seconds merges days into larger Rscript ranges
+        windows = plan_windows(
+            lastendtime_avm, lastendtime_rot, seconds=self.avm_window_seconds)
+        print('AVM Lastendtime: {}, ROT Transform Lastendtime: {}, '
+              'windows: {}, window_workers: {}'.format(
+                  lastendtime_avm, lastendtime_rot,
+                  len(windows), self.window_workers))
 
-            starttime += timedelta(seconds=86400)
-            if starttime < lastendtime_rot:
-                endtime = starttime
-            else:
-                endtime = lastendtime_rot
-
-            # run rscript_avm
-            ret = rscript_avm(
-                r='TLCD_Nikon_VM_Fcn',
-                starttime=starttime,
-                endtime=endtime
+        def advance(last_endtime):
+            print('Update {} lastendtime: {}'.format(apname, last_endtime))
+            self.fdc_psql.update_lastendtime(
+                toolid=self.toolid,
+                apname=apname,
+                last_endtime=last_endtime
             )
 
-            # TODO ????
-            if ret:
-                try:
-                    # Update lastendtime table
-                    self.fdc_psql.update_lastendtime(
-                        toolid=self.toolid,
-                        apname=apname,
-                        last_endtime=endtime
-                    )
-                except Exception as e:
-                    raise e
+        return WindowScheduler(
+            windows=windows,
+            workers=self.window_workers
+        ).run(execute=self.execute_r_avm, advance=advance)
+
+    def execute_r_avm(self, starttime, endtime):
+        """run rscript_avm for one window, a failed Rscript raises so the
+        watermark does not pass the window.
+        """
+        print('{0} AVM Start {1} - {2} {0}'.format(
+            "**" * 3, starttime, endtime))
+        ret = rscript_avm(
+            r='TLCD_Nikon_VM_Fcn',
+            toolid=self.toolid,
+            starttime=starttime.strftime('%Y-%m-%d %H:%M:%S'),
+            endtime=endtime.strftime('%Y-%m-%d %H:%M:%S')
+        )
+        msg = decode_cmd_out(ret[self.toolid])
+        print('args: {}, stdout: {}'.format(
+            msg.args, msg.stdout.replace('\r', '')))
+        print('return code: {}, stderr: {}'.format(msg.returncode, msg.stderr))
+        if msg.returncode:
+            raise sp.CalledProcessError(
+                msg.returncode, msg.args, output=msg.stdout, stderr=msg.stderr)
+        return msg
 
-    @classmethod
     def execute_r_rot(self, toolid, update_starttime, update_endtime):
-        # run rscript
+        # run rscript, or a job of the persistent R worker
         print('{0} ROT Start {0}'.format("**" * 3))
-        ret = rscript_rot(
-            r='rot.R',
-            toolid=toolid,
-            update_starttime=update_starttime.strftime('%Y-%m-%d %H:%M:%S'),
-            update_endtime=update_endtime.strftime('%Y-%m-%d %H:%M:%S')
-        )
-        msg = decode_cmd_out(ret[toolid])
+        starttime = update_starttime.strftime('%Y-%m-%d %H:%M:%S')
+        endtime = update_endtime.strftime('%Y-%m-%d %H:%M:%S')
+        if self.r_pool is not None:
+            msg = self.r_pool.call(
+                job='rot',
+                toolid=toolid,
+                update_starttime=starttime,
+                update_endtime=endtime
+            )
+        else:
+            ret = rscript_rot(
+                r='rot.R',
+                toolid=toolid,
+                update_starttime=starttime,
+                update_endtime=endtime
+            )
+            msg = decode_cmd_out(ret[toolid])
         print('args: {}, stdout: {}'.format(
             msg.args, msg.stdout.replace('\r', '')))
         print('return code: {}, stderr: {}'.format(msg.returncode, msg.stderr))
         print('{0} ROT End {0}'.format("**" * 3))
+        if msg.returncode:
+            raise sp.CalledProcessError(
+                msg.returncode, msg.args, output=msg.stdout, stderr=msg.stderr)
         return msg
 
-    @classmethod
     def execute_r_rotmea(self, toolid, update_starttime, update_endtime):
-        # run rscript
+        # run rscript, or a job of the persistent R worker
         print('{0} ROT Mea Start {0}'.format("**" * 3))
-        ret = rscript_mea(
-            r='mea.R',
-            toolid=toolid,
-            update_starttime=update_starttime.strftime('%Y-%m-%d %H:%M:%S'),
-            update_endtime=update_endtime.strftime('%Y-%m-%d %H:%M:%S')
-        )
-        msg = decode_cmd_out(ret[toolid])
+        starttime = update_starttime.strftime('%Y-%m-%d %H:%M:%S')
+        endtime = update_endtime.strftime('%Y-%m-%d %H:%M:%S')
+        if self.r_pool is not None:
+            msg = self.r_pool.call(
+                job='mea',
+                toolid=toolid,
+                update_starttime=starttime,
+                update_endtime=endtime
+            )
+        else:
+            ret = rscript_mea(
+                r='mea.R',
+                toolid=toolid,
+                update_starttime=starttime,
+                update_endtime=endtime
+            )
+            msg = decode_cmd_out(ret[toolid])
         print('args: {}, stdout: {}'.format(
             msg.args, msg.stdout.replace('\r', '')))
         print('return code: {}, stderr: {}'.format(msg.returncode, msg.stderr))
         print('{0} ROT Mea End {0}'.format("**" * 3))
+        if msg.returncode:
+            raise sp.CalledProcessError(
+                msg.returncode, msg.args, output=msg.stdout, stderr=msg.stderr)
         return msg
 
 
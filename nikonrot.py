@@ -0,0 +1,433 @@
+# -*- coding:utf-8 -*-
+"""Nikon ROT and ROT Mea in Python, port of R/tlcd_nikonrot.R and
+R/tlcd_nikonrot_mea.R
+
+min_res_squared (R/basic_fun.R) is the sum of
+    (x + shift_x - dy * tan(rot))^2 + (y + shift_y + dx * tan(rot))^2
+which is linear least squares in (shift_x, shift_y, tan(rot)). All glasses
+of a product share the design values, so one lstsq call solves them all.
+"""
+import re
+
+import numpy as np
+
+from collections import OrderedDict
+from datetime import datetime
+
+
+# rotation is in urad.
+ROT_SCALE = 0.000001
+
+ID_COLUMNS = ['tstamp', 'glassid', 'toolid', 'operation', 'product']
+MEA_ID_COLUMNS = ['tstamp', 'glassid', 'operation', 'product']
+
+# sites kept by clean_data and points per x column in mea_label_new_id
+MEA_MAX_SITE = 48
+MEA_GROUP = 6
+TP_PARAMS = {'TP_X': 0, 'TP_Y': 1}
+
+ALG_X = re.compile(r'^plfn_al\d[x]\d_x')
+ALG_Y = re.compile(r'^plfn_al\d[y]\d_x')
+
+
+def sort_rotcols(rot_cols):
+    """order like R: substring(col, 10, 10) then substring(col, 8, 8)
+    """
+    return sorted(rot_cols, key=lambda col: (col[9:10], col[7:8]))
+
+
+def coord_checking(dv_x, dv_y):
+    """justify the coordinates of design values, see R coord_checking
+    :rtype: (x, y) arrays ordered by x then y, None if
+        #distinct x * #distinct y != #rows
+    """
+    x_coord = np.unique(dv_x)
+    y_coord = np.unique(dv_y)
+    if len(x_coord) * len(y_coord) != len(dv_x):
+        return None
+    grid_x, grid_y = np.meshgrid(x_coord, y_coord, indexing='ij')
+    return grid_x.ravel(), grid_y.ravel()
+
+
+def solve_rot(mat_x, mat_y, dv_x, dv_y):
+    """fit shift x, shift y and rotation of every glass at once
+    :types: mat_x, mat_y: array(glass, point) measured coordinates
+    :types: dv_x, dv_y: array(point) design value coordinates
+    :rtype: (params array(glass, 3) of shift_x, shift_y, rot [urad],
+             rs_x array(glass, point), rs_y array(glass, point))
+    """
+    mat_x = np.atleast_2d(np.asarray(mat_x, dtype=float))
+    mat_y = np.atleast_2d(np.asarray(mat_y, dtype=float))
+    dv_x = np.asarray(dv_x, dtype=float)
+    dv_y = np.asarray(dv_y, dtype=float)
+    points = len(dv_x)
+    if mat_x.shape[1] != points or mat_y.shape[1] != points:
+        raise ValueError(
+            '{} x / {} y alignment points, {} design values'.format(
+                mat_x.shape[1], mat_y.shape[1], points))
+
+    design = np.zeros((2 * points, 3))
+    design[:points, 0] = 1
+    design[:points, 2] = -dv_y
+    design[points:, 1] = 1
+    design[points:, 2] = dv_x
+    target = -np.hstack([mat_x, mat_y]).T
+    (shift_x, shift_y, tan_rot), _, _, _ = np.linalg.lstsq(
+        design, target, rcond=-1)
+
+    rs_x = mat_x + shift_x[:, None] - np.outer(tan_rot, dv_y)
+    rs_y = mat_y + shift_y[:, None] + np.outer(tan_rot, dv_x)
+    params = np.column_stack(
+        [shift_x, shift_y, np.arctan(tan_rot) / ROT_SCALE])
+    return params, rs_x, rs_y
+
+
+def pivot_mea(rawdata):
+    """pivot the long get_measrotdata rows of every glass at once,
+    like clean_data of R/tlcd_nikonrot_mea.R
+    :types: rawdata: dbs.nikon.ResultSet of EdaOracle.get_measrotdata
+    :rtype: (list(tuple) of MEA_ID_COLUMNS ordered by tstamp,
+             array(glass, site, TP_X/TP_Y), nan if not measured)
+    """
+    index = rawdata.index
+    glasses = OrderedDict()
+    sites = OrderedDict()
+    cells = []
+    rows = sorted(rawdata.rows, key=lambda row: row[index['GLASS_START_TIME']])
+    for row in rows:
+        try:
+            site = float(row[index['SITE_NAME']])
+        except (TypeError, ValueError):
+            continue
+        if not site <= MEA_MAX_SITE:
+            continue
+        key = (
+            row[index['GLASS_START_TIME']],
+            row[index['GLASS_ID']],
+            row[index['STEP_ID']],
+            'TL{}'.format(row[index['PARAM_COLLECTION']][4:])
+        )
+        value = row[index['PARAM_VALUE']]
+        cells.append((
+            glasses.setdefault(key, len(glasses)),
+            sites.setdefault(site, len(sites)),
+            TP_PARAMS[row[index['PARAM_NAME']]],
+            np.nan if value is None else float(value)
+        ))
+
+    tp = np.full((len(glasses), len(sites), len(TP_PARAMS)), np.nan)
+    if cells:
+        glass_idx, site_idx, param_idx, values = zip(*cells)
+        tp[glass_idx, site_idx, param_idx] = values
+    return list(glasses), tp
+
+
+def label_mea(mat_x, mat_y, group=MEA_GROUP):
+    """order the points of every glass like mea_label_new_id, columns of
+    `group` points by x, then by y inside a column, the item order of
+    coord_checking.
+    :types: mat_x, mat_y: array(glass, point)
+    :rtype: (mat_x, mat_y) reordered
+    """
+    glass, points = mat_x.shape
+    if points % group:
+        raise ValueError('{} points is not a multiple of {}'.format(
+            points, group))
+    rows = np.arange(glass)[:, None]
+    by_x = np.argsort(mat_x, axis=1, kind='mergesort')
+    columns = by_x.reshape(glass, points // group, group)
+    by_y = np.argsort(
+        mat_y[rows, by_x].reshape(glass, points // group, group),
+        axis=2, kind='mergesort')
+    order = columns[
+        np.arange(glass)[:, None, None],
+        np.arange(points // group)[None, :, None],
+        by_y
+    ].reshape(glass, points)
+    return mat_x[rows, order], mat_y[rows, order]
+
+
+class RotEngine:
+    """ROT of one tool window, same flow and records as
+    tlcd_nikonrot_flow but solved in process.
+    :types: fdc_psql: dbs.nikon.FdcPGSQL
+    :types: debug: bool, if True do not insert, like R DEBUG
+    :types: page_size: int, read rawdata in keyset pages of page_size rows
+    """
+    dvtable = 'tlcd_nikon_dv_ct'
+    id_columns = ID_COLUMNS
+
+    def __init__(self, fdc_psql, debug=False, page_size=None):
+        self.fdc_psql = fdc_psql
+        self.debug = debug
+        self.page_size = page_size
+
+    def run(self, toolid, update_starttime, update_endtime):
+        """
+        :rtype: OrderedDict(product: glass count)
+        """
+        rawdata = self.fdc_psql.get_nikonrot(
+            toolid=toolid,
+            update_starttime=update_starttime,
+            update_endtime=update_endtime,
+            page_size=self.page_size,
+            columnar=True
+        )
+        print('ROT engine {} rows: {}'.format(toolid, len(rawdata)))
+        if not len(rawdata):
+            return OrderedDict()
+
+        rot_cols = sort_rotcols(self.fdc_psql.get_rotcols())
+        ids, values = self.clean_data(rawdata, rot_cols)
+
+        products = np.array([row[-1] for row in ids], dtype=object)
+        no_dv = self.check_designvalue(ids=ids, products=products)
+
+        missing = np.isnan(values).any(axis=1) & ~no_dv
+        if missing.any():
+            missing_cols = [
+                col for col, has_nan in
+                zip(rot_cols, np.isnan(values[missing]).any(axis=0))
+                if has_nan
+            ]
+            self.save_error(
+                ids=[ids[i] for i in np.flatnonzero(missing)],
+                flag=-1,
+                descr='Missing Values in Nikon PLFN {}'.format(
+                    ', '.join(missing_cols))
+            )
+
+        keep = ~(no_dv | missing)
+        alg_x = [idx for idx, col in enumerate(rot_cols) if ALG_X.match(col)]
+        alg_y = [idx for idx, col in enumerate(rot_cols) if ALG_Y.match(col)]
+        items = [rot_cols[i] for i in alg_x + alg_y]
+
+        rot_by_prodt = OrderedDict()
+        for prodt in OrderedDict.fromkeys(products[keep]):
+            rows = np.flatnonzero(keep & (products == prodt))
+            rot_by_prodt[prodt] = self.rot_product(
+                prodt=prodt,
+                ids=[ids[i] for i in rows],
+                mat_x=values[np.ix_(rows, alg_x)],
+                mat_y=values[np.ix_(rows, alg_y)],
+                items=items
+            )
+        return rot_by_prodt
+
+    def check_designvalue(self, ids, products):
+        """save flag -2 for the products without design values
+        :rtype: array(bool) of the glasses without design values
+        """
+        prod_with_dv = list(self.fdc_psql.get_prodwithdv())
+        no_dv = ~np.isin(products, prod_with_dv)
+        for prodt in OrderedDict.fromkeys(products[no_dv]):
+            self.save_error(
+                ids=[ids[i] for i in np.flatnonzero(products == prodt)],
+                flag=-2,
+                descr='No Design Values in Product {}'.format(prodt)
+            )
+        return no_dv
+
+    def get_designvalue(self, prodt, ids):
+        """design values of prodt ordered by coord_checking, flag -3 and
+        None if the coordinates are not a grid
+        """
+        dv = self.fdc_psql.get_designvalue(prodt=prodt, dvtable=self.dvtable)
+        coord = coord_checking(
+            np.array([row['x'] for row in dv], dtype=float),
+            np.array([row['y'] for row in dv], dtype=float)
+        )
+        if coord is None:
+            print('product: {}, #Distinct X * #Distinct Y != #Rows'.format(
+                prodt))
+            self.save_error(
+                ids=ids,
+                flag=-3,
+                descr="'#Distinct X * #Distinct Y != #Rows' in Product "
+                      "{}".format(prodt)
+            )
+        return coord
+
+    def fit(self, prodt, ids, mat_x, mat_y, dv_x, dv_y, items):
+        """solve_rot and save rot_rs, flag -4 if it fails
+        """
+        try:
+            params, rs_x, rs_y = solve_rot(mat_x, mat_y, dv_x, dv_y)
+        except ValueError as e:
+            print('product: {}, Error: {}'.format(prodt, e))
+            self.save_error(ids=ids, flag=-4, descr='ROT Error: {}'.format(e))
+            return
+
+        rot_rs = np.hstack([rs_x, rs_y])
+        self.save_rot(
+            ids=ids,
+            values=[list(zip(items, rs.tolist())) for rs in rot_rs]
+        )
+
+    def clean_data(self, rawdata, rot_cols):
+        """ids and float values of rot_cols, ordered by tstamp
+        :types: rawdata: dbs.nikon.ColumnarResult
+        :rtype: (list(tuple) of ID_COLUMNS, array(row, rot_cols))
+        """
+        rawdata = rawdata.take(
+            np.argsort(rawdata['tstamp'], kind='mergesort'))
+        ids = list(zip(*[rawdata[col].tolist() for col in ID_COLUMNS]))
+        return ids, rawdata.matrix(rot_cols)
+
+    def rot_product(self, prodt, ids, mat_x, mat_y, items):
+        """fit every glass of one product and save rot_rs
+        :rtype: int, glass count
+        """
+        coord = self.get_designvalue(prodt=prodt, ids=ids)
+        if coord is None:
+            return 0
+        self.fit(prodt, ids, mat_x, mat_y, *coord, items=items)
+        return len(ids)
+
+    def save_rot(self, ids, values):
+        if self.debug:
+            print('DEBUG MODE, not insert DATA')
+            return
+        self.fdc_psql.save_rot(
+            columns=self.id_columns,
+            records=[(row + (1,), rs) for row, rs in zip(ids, values)]
+        )
+
+    def save_error(self, ids, flag, descr):
+        print('ROT error flag {}: {} glass, {}'.format(flag, len(ids), descr))
+        if self.debug:
+            print('DEBUG MODE, not insert DATA')
+            return
+        self.fdc_psql.save_rot_error(
+            columns=self.id_columns,
+            rows=[row + (flag, descr) for row in ids]
+        )
+
+
+class MeaEngine(RotEngine):
+    """ROT Mea of one window, same flow and records as
+    tlcd_nikonrotmea_flow. The measurements of every glass are pivoted at
+    once and labeled by label_mea instead of hclust per glass.
+    :types: eda_oracle: dbs.nikon.EdaOracle
+    """
+    dvtable = 'tlcd_nikon_mea_dv_ct'
+    id_columns = MEA_ID_COLUMNS
+
+    def __init__(self, fdc_psql, eda_oracle, debug=False):
+        super(MeaEngine, self).__init__(fdc_psql=fdc_psql, debug=debug)
+        self.eda_oracle = eda_oracle
+
+    def run(self, update_starttime, update_endtime, rawdata=None):
+        """
+        :types: rawdata: get_measrotdata of the window if already fetched
+        :rtype: OrderedDict(product: glass count)
+        """
+        if rawdata is None:
+            rawdata = self.eda_oracle.get_measrotdata(
+                update_starttime=update_starttime,
+                update_endtime=update_endtime
+            )
+        print('MEA engine rows: {}'.format(len(rawdata)))
+        if not len(rawdata):
+            return OrderedDict()
+
+        ids, tp = pivot_mea(rawdata)
+        products = np.array([row[-1] for row in ids], dtype=object)
+        no_dv = self.check_designvalue(ids=ids, products=products)
+
+        nan = np.isnan(tp)
+        present = ~nan.all(axis=2)
+        counts = present.sum(axis=1)
+        missing = (
+            (nan.any(axis=2) & present).any(axis=1) |
+            (counts == 0) | (counts % MEA_GROUP != 0)
+        ) & ~no_dv
+        if missing.any():
+            self.save_error(
+                ids=[ids[i] for i in np.flatnonzero(missing)],
+                flag=-1,
+                descr='Missing Values'
+            )
+
+        keep = ~(no_dv | missing)
+        rot_by_prodt = OrderedDict()
+        for prodt in OrderedDict.fromkeys(products[keep]):
+            rows = np.flatnonzero(keep & (products == prodt))
+            rot_by_prodt[prodt] = self.rot_product(
+                prodt=prodt,
+                ids=[ids[i] for i in rows],
+                tp=tp[rows],
+                present=present[rows]
+            )
+        return rot_by_prodt
+
+    def rot_product(self, prodt, ids, tp, present):
+        """label, diff to the design values and fit every glass of one
+        product, glasses with the same point count are solved together.
+        :rtype: int, glass count
+        """
+        coord = self.get_designvalue(prodt=prodt, ids=ids)
+        if coord is None:
+            return 0
+        dv_x, dv_y = coord
+
+        counts = present.sum(axis=1)
+        for points in np.unique(counts):
+            rows = np.flatnonzero(counts == points)
+            glass_ids = [ids[i] for i in rows]
+            if points != len(dv_x):
+                self.save_error(
+                    ids=glass_ids,
+                    flag=-4,
+                    descr='ROT Error: {} points, {} design values'.format(
+                        points, len(dv_x))
+                )
+                continue
+            mask = present[rows]
+            tp_x, tp_y = label_mea(
+                tp[rows, :, 0][mask].reshape(len(rows), points),
+                tp[rows, :, 1][mask].reshape(len(rows), points)
+            )
+            items = (['X_{}'.format(i + 1) for i in range(points)] +
+                     ['Y_{}'.format(i + 1) for i in range(points)])
+            self.fit(prodt, glass_ids, tp_x - dv_x, tp_y - dv_y,
+                     dv_x, dv_y, items=items)
+        return len(ids)
+
+
+def rot_main(fdc_psql, toolid, update_starttime, update_endtime, debug=False,
+             page_size=None):
+    """run RotEngine and print the elapsed time like tlcd_nikonrot_flow
+    """
+    rot_starttime = datetime.now()
+    print('START: {}'.format(rot_starttime))
+    rot_by_prodt = RotEngine(
+        fdc_psql=fdc_psql, debug=debug, page_size=page_size
+    ).run(
+        toolid=toolid,
+        update_starttime=update_starttime,
+        update_endtime=update_endtime
+    )
+    rot_endtime = datetime.now()
+    print('END: {}, Elapsed time: {}'.format(
+        rot_endtime, rot_endtime - rot_starttime))
+    return rot_by_prodt
+
+
+def mea_main(fdc_psql, eda_oracle, update_starttime, update_endtime,
+             rawdata=None, debug=False):
+    """run MeaEngine and print the elapsed time like tlcd_nikonrotmea_flow
+    """
+    rot_starttime = datetime.now()
+    print('START: {}'.format(rot_starttime))
+    rot_by_prodt = MeaEngine(
+        fdc_psql=fdc_psql, eda_oracle=eda_oracle, debug=debug
+    ).run(
+        update_starttime=update_starttime,
+        update_endtime=update_endtime,
+        rawdata=rawdata
+    )
+    rot_endtime = datetime.now()
+    print('END: {}, Elapsed time: {}'.format(
+        rot_endtime, rot_endtime - rot_starttime))
+    return rot_by_prodt
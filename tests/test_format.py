@@ -1,9 +1,31 @@
 # content of test_sample.py
 import unittest
 import datetime
+import decimal
+import gc
+import os
+import subprocess as sp
+import tempfile
+import threading
 import pytest
+import cx_Oracle
+import numpy as np
 
-from nikon_ETL import Base
+from contextlib import contextmanager
+from unittest import mock
+
+from nikon_ETL import (
+    Base, BaseInsert, ETL, ParsedCompletedCommand, plan_windows,
+    plan_row_windows, WindowScheduler, TlcdFlowError, tool_starttimes)
+from dbs.nikon import (
+    copy_buffer, chunked, merge_stage_sql, ResultSet, KeysetReader,
+    ColumnarResult)
+from dbs import nikon
+from dbs.db_fdc import output_type_handler
+from dbs.db_pg import prepare
+from dbs.window_cache import WindowCache
+from nikonrot import (
+    coord_checking, solve_rot, sort_rotcols, pivot_mea, label_mea)
 
 
 def func(x):
@@ -35,10 +57,116 @@ class TestFormat(unittest.TestCase, Base):
     def test_clean_edcdata(self):
         pass
 
+    def test_column_projection(self):
+        project = self.column_projection(
+            edc_columns=['TSTAMP', 'EXTRA', 'GLASSID', 'TOOLID'],
+            schemacolnames=['TOOLID', 'GLASSID', 'TSTAMP'])
+        rows = [('t1', 'x', 'g1', 'TLCD0501'), ('t2', 'y', 'g2', 'TLCD0501')]
+        assert self.clean_edcrows(rows=rows, project=project) == [
+            ('TLCD0501', 'g1', 't1'), ('TLCD0501', 'g2', 't2')]
+
+    def test_column_projection_missing(self):
+        assert self.column_projection(
+            edc_columns=['TSTAMP'],
+            schemacolnames=['TSTAMP', 'GLASSID']) is None
+
     def test_clean_schemacolnames(self):
         pass
 
 
+class TestPlanWindows(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2017, 10, 26, 8, 0, 0)
+        self.end = datetime.datetime(2017, 10, 27, 20, 0, 0)
+
+    def test_plan_windows(self):
+        windows = plan_windows(self.start, self.end, seconds=86400)
+        assert windows == [
+            (self.start, datetime.datetime(2017, 10, 27, 8, 0, 0)),
+            (datetime.datetime(2017, 10, 27, 8, 0, 0), self.end),
+        ]
+        assert plan_windows(self.start, self.end) == [(self.start, self.end)]
+        assert plan_windows(self.end, self.start) == []
+
+    def test_plan_row_windows(self):
+        endtimes = [self.start + datetime.timedelta(hours=h)
+                    for h in (1, 2, 2, 3, 5)]
+        windows = plan_row_windows(self.start, self.end, endtimes, rows=2)
+        assert windows == [
+            (self.start, endtimes[1]),
+            (endtimes[1], endtimes[3]),
+            (endtimes[3], self.end),
+        ]
+
+
+class TestCopyFormat(unittest.TestCase):
+
+    def test_copy_buffer(self):
+        rows = [
+            ('TLCD0501', None, 'a\tb\\c'),
+            ('TLCD0501', datetime.datetime(2017, 10, 26, 23, 31, 27), 1.5),
+        ]
+        assert copy_buffer(rows).read() == (
+            'TLCD0501\t\\N\ta\\tb\\\\c\n'
+            'TLCD0501\t2017-10-26 23:31:27\t1.5\n'
+        )
+
+    def test_chunked(self):
+        assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+    def test_merge_stage_sql(self):
+        delete_sql, update_sql, insert_sql = merge_stage_sql(
+            table='tlcd0501_rawdata',
+            columns=['glassid', 'tstamp', 'value'],
+            keys=['glassid', 'tstamp'],
+            window_column='tstamp',
+            where='AND t."toolid" LIKE %(tlcd)s'
+        )
+
+        def normalize(sql):
+            return ' '.join(sql.split())
+        assert normalize(delete_sql) == (
+            'DELETE FROM tlcd0501_rawdata t '
+            'WHERE t."tstamp" > %(psql_lastendtime)s '
+            'AND t."tstamp" <= %(ora_lastendtime)s '
+            'AND t."toolid" LIKE %(tlcd)s '
+            'AND NOT EXISTS ( SELECT 1 FROM tlcd0501_rawdata_stage s '
+            'WHERE s."glassid" = t."glassid" AND s."tstamp" = t."tstamp" )')
+        assert normalize(update_sql) == (
+            'UPDATE tlcd0501_rawdata t SET "value" = s."value" '
+            'FROM tlcd0501_rawdata_stage s '
+            'WHERE s."glassid" = t."glassid" AND s."tstamp" = t."tstamp" '
+            'AND (t."value") IS DISTINCT FROM (s."value")')
+        assert normalize(insert_sql) == (
+            'INSERT INTO tlcd0501_rawdata ("glassid", "tstamp", "value") '
+            'SELECT "glassid", "tstamp", "value" '
+            'FROM tlcd0501_rawdata_stage s '
+            'WHERE NOT EXISTS ( SELECT 1 FROM tlcd0501_rawdata t '
+            'WHERE s."glassid" = t."glassid" AND s."tstamp" = t."tstamp" )')
+
+
+class TestResultSet(unittest.TestCase, Base):
+
+    def setUp(self):
+        self.rows = ResultSet(
+            ['TOOLID', 'GLASSID'],
+            [('TLCD0501', 'g1'), ('TLCD0801', 'g2')]
+        )
+
+    def test_row_access(self):
+        assert len(self.rows) == 2
+        assert self.rows[1]['GLASSID'] == 'g2'
+        assert self.rows[1][0] == 'TLCD0801'
+        assert [row['TOOLID'] for row in self.rows] == [
+            'TLCD0501', 'TLCD0801']
+
+    def test_clean_edcdata(self):
+        assert self.clean_edcdata(
+            edc_data=self.rows, schemacolnames=['GLASSID', 'TOOLID']
+        ) == [('g1', 'TLCD0501'), ('g2', 'TLCD0801')]
+
+
 class TestDB(unittest.TestCase):
     """docstring for TestDB
     should init a mock db
@@ -46,3 +174,539 @@ class TestDB(unittest.TestCase):
     
     def setUp(self):
         pass
+
+
+def test_tool_starttimes():
+    start = datetime.datetime(2017, 11, 1)
+    end = start + datetime.timedelta(days=1)
+    starttimes = tool_starttimes(
+        toolids=['tlcd0601', 'tlcd0501', 'tlcd0701'],
+        psql_lastendtime=start,
+        ora_lastendtime=end,
+        tool_lastendtimes={
+            'tlcd0501': start + datetime.timedelta(hours=6),
+            'tlcd0601': end,
+            'tlcd0701': start - datetime.timedelta(days=1),
+        }
+    )
+    assert starttimes == {
+        'tlcd0501': start + datetime.timedelta(hours=6),
+        'tlcd0701': start,
+    }
+    assert list(tool_starttimes(['b', 'a'], start, end)) == ['a', 'b']
+
+
+class TestWindowScheduler(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime.datetime(2017, 11, 1)
+        self.windows = plan_windows(
+            start, start + datetime.timedelta(days=4), seconds=86400)
+
+    def test_advance_in_order(self):
+        events = {window: threading.Event() for window in self.windows}
+        advanced = []
+
+        def execute(starttime, endtime):
+            # later windows finish first
+            idx = self.windows.index((starttime, endtime))
+            if idx + 1 < len(self.windows):
+                assert events[self.windows[idx + 1]].wait(5)
+            events[(starttime, endtime)].set()
+
+        watermark = WindowScheduler(self.windows, workers=4).run(
+            execute=execute, advance=advanced.append)
+        assert advanced == [self.windows[-1][1]]
+        assert watermark == self.windows[-1][1]
+
+    def test_stop_at_failure(self):
+        advanced = []
+
+        def execute(starttime, endtime):
+            if (starttime, endtime) == self.windows[2]:
+                raise ValueError('window failed')
+
+        with pytest.raises(TlcdFlowError) as excinfo:
+            WindowScheduler(self.windows, workers=1).run(
+                execute=execute, advance=advanced.append)
+        assert advanced == [self.windows[0][1], self.windows[1][1]]
+        assert list(excinfo.value.errors) == [self.windows[2]]
+
+
+class FakePGSQL:
+
+    def __init__(self):
+        self.events = []
+
+    @contextmanager
+    def transaction(self, commit_every=None):
+        self.events.append('begin')
+        try:
+            yield self
+        except Exception:
+            self.events.append('rollback')
+            raise
+        self.events.append('commit')
+
+    @contextmanager
+    def savepoint(self):
+        try:
+            yield self
+        except Exception:
+            self.events.append('rollback to savepoint')
+            raise
+
+    def update_lastendtimes(self, apname, last_endtimes):
+        self.events.append(('update_lastendtimes', dict(last_endtimes)))
+
+    def derive_lastendtime(self, toolid, apname):
+        self.events.append('derive_lastendtime')
+
+
+class FakeInsert(BaseInsert):
+    queue_size = 1
+    commit_every = None
+
+    def __init__(self):
+        self.fdc_psql = FakePGSQL()
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.insert = FakeInsert()
+        self.batches = [
+            ResultSet(['A'], [(1,), (2,)]),
+            ResultSet(['A'], []),
+            ResultSet(['A'], [(3,)]),
+        ]
+        self.written = []
+
+    def clean(self, batch):
+        return [(row[0] * 10,) for row in batch.rows]
+
+    def write(self, fdc_psql, datas, count):
+        assert fdc_psql is self.insert.fdc_psql
+        assert count == len(self.written)
+        self.written.extend(datas)
+
+    def test_pipeline(self):
+        finished = []
+        count = self.insert.pipeline_main(
+            batches=iter(self.batches), clean=self.clean, write=self.write,
+            finish=finished.append)
+        assert count == 3
+        assert self.written == [(10,), (20,), (30,)]
+        assert finished == [self.insert.fdc_psql]
+        assert self.insert.fdc_psql.events == ['begin', 'commit']
+
+    def test_no_rows(self):
+        finished = []
+        count = self.insert.pipeline_main(
+            batches=iter([]), clean=self.clean, write=self.write,
+            finish=finished.append)
+        assert count == 0
+        assert finished == []
+
+    def test_write_error_rolls_back(self):
+        def write(fdc_psql, datas, count):
+            if count:
+                raise RuntimeError('copy failed')
+            self.written.extend(datas)
+
+        with pytest.raises(RuntimeError):
+            self.insert.pipeline_main(
+                batches=iter(self.batches), clean=self.clean, write=write)
+        assert self.insert.fdc_psql.events == ['begin', 'rollback']
+
+    def test_read_error_ends_transaction(self):
+        fdc_psql = self.insert.fdc_psql = nikon.FdcPGSQL()
+
+        def batches():
+            yield self.batches[0]
+            raise RuntimeError('fetch failed')
+
+        with mock.patch.object(nikon.db_pg, 'commit') as commit, \
+                mock.patch.object(nikon.db_pg, 'rollback') as rollback:
+            with pytest.raises(RuntimeError):
+                with fdc_psql.transaction():
+                    self.insert.pipeline_main(
+                        batches=batches(), clean=self.clean,
+                        write=self.write)
+            # a half-open writer transaction would end here
+            gc.collect()
+        assert fdc_psql._depth == 0
+        rollback.assert_called_once_with()
+        commit.assert_not_called()
+
+
+class PerToolETL(ETL):
+
+    def dbtransfer(self, apname, ora_lastendtime, psql_lastendtime):
+        return ['tlcd0501', 'tlcd0601']
+
+    def tlcd_tool(self, toolid, psql_lastendtime, ora_lastendtime):
+        if toolid == 'tlcd0601':
+            raise RuntimeError('copy failed')
+        return 1
+
+
+class TestEtlWindowPerTool(unittest.TestCase):
+
+    def test_failed_tool_keeps_watermark(self):
+        etl = PerToolETL(toolid='NIKON')
+        etl.fdc_psql = FakePGSQL()
+        start = datetime.datetime(2017, 11, 1)
+        end = start + datetime.timedelta(days=1)
+        tool_lastendtimes = {'tlcd0501': start, 'tlcd0601': start}
+        with mock.patch.object(
+                nikon.schema_cache, 'toolids', return_value=[]):
+            with pytest.raises(TlcdFlowError) as excinfo:
+                etl.etl_window_per_tool(
+                    apname='EDC_Import',
+                    psql_lastendtime=start,
+                    ora_lastendtime=end,
+                    tool_lastendtimes=tool_lastendtimes
+                )
+        assert list(excinfo.value.errors) == ['tlcd0601']
+        assert excinfo.value.result == {'tlcd0501': 1}
+        assert etl.fdc_psql.events == [
+            'begin',
+            'rollback to savepoint',
+            ('update_lastendtimes', {'tlcd0501': end}),
+            'derive_lastendtime',
+            'commit',
+        ]
+        assert tool_lastendtimes == {'tlcd0501': end, 'tlcd0601': start}
+
+
+class CopyETL(ETL):
+
+    def tlcd_tool(self, toolid, psql_lastendtime, ora_lastendtime):
+        return self.fdc_psql.copy_edcdata(
+            toolid=toolid, edcdatas=[(1,)] * 3, batch_size=1)
+
+
+class TestTlcdFlow(unittest.TestCase):
+
+    def test_sequential_group_commits(self):
+        etl = CopyETL(toolid='NIKON')
+        start = datetime.datetime(2017, 11, 1)
+        end = start + datetime.timedelta(days=1)
+        with mock.patch.object(nikon.db_pg, 'get_cursor'), \
+                mock.patch.object(nikon.db_pg, 'commit') as commit:
+            with etl.fdc_psql.transaction(commit_every=2):
+                result = etl.tlcd_flow(
+                    toolids=['tlcd0501', 'tlcd0601'],
+                    apname='EDC_Import',
+                    psql_lastendtime=start,
+                    ora_lastendtime=end
+                )
+        assert result == {'tlcd0501': 3, 'tlcd0601': 3}
+        # every 2 of the 6 rows, then the transaction itself
+        assert commit.call_count == 4
+
+
+class FakeRPool:
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def call(self, job, toolid, update_starttime, update_endtime):
+        return ParsedCompletedCommand(
+            self.returncode, [job, toolid], 'log', 'message')
+
+
+class TestExecuteR(unittest.TestCase):
+
+    def setUp(self):
+        self.etl = ETL(toolid='NIKON')
+        self.start = datetime.datetime(2017, 11, 1)
+        self.end = self.start + datetime.timedelta(days=1)
+
+    def test_ok(self):
+        self.etl.r_pool = FakeRPool(returncode=0)
+        msg = self.etl.execute_r_rot('tlcd0501', self.start, self.end)
+        assert msg.returncode == 0
+
+    def test_failed_job_raises(self):
+        self.etl.r_pool = FakeRPool(returncode=1)
+        for execute in (self.etl.execute_r_rot, self.etl.execute_r_rotmea):
+            with pytest.raises(sp.CalledProcessError):
+                execute('tlcd0501', self.start, self.end)
+
+
+class TestColumnarResult(unittest.TestCase):
+
+    def setUp(self):
+        self.tstamp = datetime.datetime(2017, 11, 1)
+        self.result = ColumnarResult.from_rows(
+            ['glassid', 'tstamp', 'count', 'plfn_al1x1_x', 'plfn_al1y1_x'],
+            [('G1', self.tstamp, 3, 1.5, None),
+             ('G2', self.tstamp, 4, 2, None)]
+        )
+
+    def test_dtypes(self):
+        assert self.result['glassid'].dtype == object
+        assert self.result['tstamp'].dtype == object
+        assert self.result['count'].dtype == np.int64
+        assert self.result['plfn_al1x1_x'].tolist() == [1.5, 2.0]
+        assert len(self.result) == 2
+
+    def test_take_matrix(self):
+        subset = self.result.take(self.result['glassid'] == 'G2')
+        assert subset['glassid'].tolist() == ['G2']
+        matrix = subset.matrix(['plfn_al1x1_x', 'plfn_al1y1_x'])
+        assert matrix.shape == (1, 2)
+        assert matrix[0, 0] == 2 and np.isnan(matrix[0, 1])
+
+    def test_empty(self):
+        result = ColumnarResult.from_rows(['glassid'], [])
+        assert len(result) == 0
+        assert result.to_resultset().rows == []
+
+
+def test_prepare():
+    name, sql, names = prepare(
+        "SELECT * FROM t WHERE a >= %(start)s AND b < %(end)s "
+        "AND c <> %(start)s AND d LIKE 'TLCD%%'")
+    assert sql == (
+        "PREPARE {} AS SELECT * FROM t WHERE a >= $1 AND b < $2 "
+        "AND c <> $1 AND d LIKE 'TLCD%'".format(name))
+    assert names == ['start', 'end']
+    assert prepare('INSERT INTO t VALUES (%s,%s)')[1:] == (
+        'PREPARE {} AS INSERT INTO t VALUES ($1,$2)'.format(
+            prepare('INSERT INTO t VALUES (%s,%s)')[0]), None)
+    assert prepare('SELECT 1')[0] != prepare('SELECT 2')[0]
+
+
+def test_output_type_handler():
+    class Cursor:
+        arraysize = 100
+
+        def var(self, type_, arraysize):
+            return type_, arraysize
+
+    cursor = Cursor()
+    # NUMBER(10, 2)
+    assert output_type_handler(
+        cursor, 'VALUE', cx_Oracle.NUMBER, 22, 10, 2) == (
+        cx_Oracle.NATIVE_FLOAT, 100)
+    # NUMBER(10) and unconstrained NUMBER keep their ints
+    assert output_type_handler(
+        cursor, 'COUNT', cx_Oracle.NUMBER, 22, 10, 0) is None
+    assert output_type_handler(
+        cursor, 'COUNT', cx_Oracle.NUMBER, 22, 0, -127) is None
+    assert output_type_handler(
+        cursor, 'GLASSID', cx_Oracle.STRING, 20, 0, 0) is None
+
+
+class ListKeysetReader(KeysetReader):
+    """KeysetReader over a sorted list, fails once after fail_after pages
+    """
+    errors = (IOError,)
+
+    def __init__(self, rows, fail_after=None, **kwargs):
+        super().__init__(table='tlcd0501_rawdata', **kwargs)
+        self.rows = rows
+        self.fail_after = fail_after
+        self.fetched = 0
+
+    def get_cursor(self):
+        raise AssertionError('fetch_page reads the list')
+
+    def release(self):
+        pass
+
+    def page_sql(self, first):
+        raise AssertionError('fetch_page reads the list')
+
+    def fetch_page(self):
+        if self.fetched == self.fail_after:
+            self.fail_after = None
+            raise IOError('connection lost')
+        self.fetched += 1
+        if self.last_key is None:
+            rows = [row for row in self.rows if row[0] > self.starttime]
+        else:
+            rows = [row for row in self.rows if row[:2] > self.last_key]
+        rows = [row for row in rows if row[0] <= self.endtime]
+        return ResultSet(['TSTAMP', 'GLASSID', 'VALUE'],
+                         rows[:self.page_size])
+
+
+class TestKeysetReader(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [(tstamp, glassid, tstamp * 10 + idx)
+                     for tstamp in range(1, 5)
+                     for idx, glassid in enumerate(['A', 'B', 'C'])]
+
+    def test_pages(self):
+        reader = ListKeysetReader(
+            self.rows, starttime=1, endtime=4, page_size=4)
+        pages = [page.rows for page in reader.pages()]
+        assert [len(page) for page in pages] == [4, 4, 1]
+        assert sum(pages, []) == self.rows[3:]
+        assert reader.last_key == (4, 'C')
+
+    def test_abstract(self):
+        class NoSqlReader(KeysetReader):
+            def get_cursor(self):
+                pass
+
+            def release(self):
+                pass
+
+        with pytest.raises(TypeError):
+            NoSqlReader(table='tlcd0501_rawdata', starttime=1, endtime=4)
+
+    def test_resume(self):
+        reader = ListKeysetReader(
+            self.rows, fail_after=1, starttime=0, endtime=3, page_size=2,
+            retries=1)
+        rows = [row for page in reader.pages() for row in page.rows]
+        assert rows == self.rows[:9]
+
+        resumed = ListKeysetReader(
+            self.rows, starttime=0, endtime=4, page_size=5, last_key=(3, 'C'))
+        assert [row for page in resumed for row in page.rows] == self.rows[9:]
+
+    def test_retries_exhausted(self):
+        reader = ListKeysetReader(
+            self.rows, fail_after=0, starttime=0, endtime=4, page_size=2)
+        with pytest.raises(IOError):
+            list(reader.pages())
+
+
+class TestWindowCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = WindowCache(path=self.tmp.name, max_bytes=10 ** 9)
+        self.start = datetime.datetime(2017, 10, 26)
+        self.end = datetime.datetime(2017, 10, 27)
+        columns = ['GLASSID', 'COUNT', 'VALUE', 'TSTAMP', 'AMOUNT', 'BIG']
+        self.batches = [
+            ResultSet(columns, [
+                ('G1', 5, 1.5, self.start, decimal.Decimal('0.1'), 2 ** 64),
+                ('G2', None, None, None, None, None),
+            ]),
+            ResultSet(columns, [
+                ('G3', 2 ** 53 + 1, float('inf'),
+                 datetime.datetime(2017, 10, 26, 1, 2, 3, 4), None, 1),
+            ]),
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def put(self, toolid, watermark=1):
+        return list(self.cache.put(
+            toolid, self.start, self.end, watermark, iter(self.batches)))
+
+    def test_round_trip(self):
+        assert self.cache.get('TLCD0100', self.start, self.end, 1) is None
+        assert self.put('TLCD0100') == self.batches
+        cached = list(self.cache.get('TLCD0100', self.start, self.end, 1))
+        assert [batch.columns for batch in cached] == [
+            batch.columns for batch in self.batches]
+        # same values and types, ints stay ints
+        for batch, expected in zip(cached, self.batches):
+            assert [[(type(value), value) for value in row]
+                    for row in batch.rows] == [
+                [(type(value), value) for value in row]
+                for row in expected.rows]
+
+    def test_partial_read_not_stored(self):
+        batches = self.cache.put(
+            'TLCD0100', self.start, self.end, 1, iter(self.batches))
+        next(batches)
+        batches.close()
+        assert self.cache.get('TLCD0100', self.start, self.end, 1) is None
+        assert os.listdir(self.tmp.name) == []
+
+    def test_watermark_moved(self):
+        self.put('TLCD0100')
+        assert self.cache.get('TLCD0100', self.start, self.end, 2) is None
+        assert self.cache.get('TLCD0100', self.start, self.end, 1) is None
+
+    def test_fetch_reads_source_once(self):
+        reads = []
+
+        def source():
+            for batch in self.batches:
+                reads.append(batch)
+                yield batch
+        for _ in range(2):
+            batches = self.cache.fetch(
+                'TLCD0100', self.start, self.end, 1, source())
+            assert sum(len(batch) for batch in batches) == 3
+        assert reads == self.batches
+
+    def test_evict(self):
+        self.put('TLCD0100')
+        self.cache.max_bytes = 0
+        self.put('TLCD0200')
+        assert self.cache.get('TLCD0100', self.start, self.end, 1) is None
+
+
+class TestSolveRot(unittest.TestCase):
+
+    def test_coord_checking(self):
+        dv_x, dv_y = coord_checking([100, 0, 100, 0], [0, 0, 50, 50])
+        assert dv_x.tolist() == [0, 0, 100, 100]
+        assert dv_y.tolist() == [0, 50, 0, 50]
+        assert coord_checking([0, 100, 50], [0, 0, 50]) is None
+
+    def test_sort_rotcols(self):
+        cols = ['plfn_al2y1_x', 'plfn_al1x2_x', 'plfn_al1y1_x']
+        assert sort_rotcols(cols) == [
+            'plfn_al1y1_x', 'plfn_al2y1_x', 'plfn_al1x2_x']
+
+    def test_solve_rot(self):
+        dv_x, dv_y = coord_checking([0, 100, 0, 100], [0, 0, 50, 50])
+        tan_rot = [0.000005, -0.00001]
+        mat_x = [[-1 + t * y for y in dv_y] for t in tan_rot]
+        mat_y = [[-2 - t * x for x in dv_x] for t in tan_rot]
+        params, rs_x, rs_y = solve_rot(mat_x, mat_y, dv_x, dv_y)
+        assert params[:, :2].round(6).tolist() == [[1, 2], [1, 2]]
+        assert params[:, 2].round(3).tolist() == [5, -10]
+        assert abs(rs_x).max() < 1e-9 and abs(rs_y).max() < 1e-9
+
+    def test_solve_rot_points(self):
+        with pytest.raises(ValueError):
+            solve_rot([[0, 0, 0]], [[0, 0, 0]], [0, 1], [0, 1])
+
+    def test_pivot_mea(self):
+        columns = ['STEP_ID', 'GLASS_ID', 'GLASS_START_TIME',
+                   'PARAM_COLLECTION', 'PARAM_NAME', 'PARAM_VALUE',
+                   'SITE_NAME']
+        start = datetime.datetime(2017, 7, 13, 20, 0, 27)
+        rows = [
+            ('1360', 'G2', start, 'TLCDABC', 'TP_X', 1.5, '2'),
+            ('1360', 'G1', start - datetime.timedelta(1), 'TLCDABC',
+             'TP_Y', 2.5, '1'),
+            ('1360', 'G2', start, 'TLCDABC', 'TP_Y', '3.5', '2'),
+            ('1360', 'G2', start, 'TLCDABC', 'TP_X', 9, '49'),
+        ]
+        ids, tp = pivot_mea(ResultSet(columns=columns, rows=rows))
+        assert ids == [
+            (start - datetime.timedelta(1), 'G1', '1360', 'TLABC'),
+            (start, 'G2', '1360', 'TLABC'),
+        ]
+        assert tp.shape == (2, 2, 2)
+        assert tp[1, 1].tolist() == [1.5, 3.5]
+        assert tp[0, 0, 1] == 2.5
+        assert np.isnan(tp[0, 0, 0]) and np.isnan(tp[0, 1]).all()
+
+    def test_label_mea(self):
+        dv_x, dv_y = coord_checking(
+            [0, 100] * 6, [y * 10 for y in range(6)] * 2)
+        order = np.random.RandomState(0).permutation(12)
+        tp_x, tp_y = label_mea(
+            np.array([dv_x[order] + 0.01]), np.array([dv_y[order] - 0.02]))
+        assert (tp_x - dv_x).round(6).tolist() == [[0.01] * 12]
+        assert (tp_y - dv_y).round(6).tolist() == [[-0.02] * 12]
+        with pytest.raises(ValueError):
+            label_mea(np.zeros((1, 8)), np.zeros((1, 8)))